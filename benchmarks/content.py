@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""Compare JSON and compact harvest object content encoding.
+
+Benchmark does not need CKAN instance, for example:
+
+    env/bin/python benchmarks/content.py -n 10000
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import datetime
+import json
+import random
+import time
+
+SENTENCES = [
+    'Duomenų rinkinyje pateikiami Lietuvos Respublikos savivaldybių gyventojų skaičiaus duomenys.',
+    'Duomenys atnaujinami kiekvieną ketvirtį pagal Gyventojų registro tarnybos pateiktą informaciją.',
+    'Rinkmenoje nurodomi įmonių pavadinimai, kodai, buveinių adresai ir veiklos teritorijos.',
+    'Informacija skirta visuomenei, mokslininkams ir valstybės institucijoms.',
+    'Šilumos tiekėjų licencijų sąrašas sudaromas pagal Valstybinės kainų ir energetikos kontrolės komisijos duomenis.',
+]
+
+
+def create_dataset(rand, i):
+    from odgovlt import CONTENT_FIELDS
+    dataset = {field: None for field in CONTENT_FIELDS}
+    dataset.update({
+        'ID': i,
+        'KODAS': 1000 + i,
+        'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+        'SANTRAUKA': ' '.join(rand.choice(SENTENCES) for _ in range(rand.randint(1, 30))),
+        'R_ZODZIAI': 'keliai, eismo intensyvumas, šiluma',
+        'USER_ID': 1,
+        'istaiga_id': 1,
+        'K_EMAIL': 'testas@testas.lt',
+        'TINKLAPIS': 'http://www.testas.lt/%d' % i,
+        'STATUSAS': 'U',
+        'TR_DATA': datetime.datetime(2017, 1, 1) + datetime.timedelta(hours=i),
+        'PUB_DATA': datetime.datetime(2017, 1, 1) + datetime.timedelta(hours=i),
+        'PERDAVIMO_DATA': datetime.datetime(2017, 1, 1),
+        'EKSPORTUOTI': 1,
+        'user': {
+            'ID': 1, 'LOGIN': 'User1', 'PASS': 'secret123', 'EMAIL': 'testas@testas.lt',
+            'FIRST_NAME': 'Jonas', 'LAST_NAME': 'Jonaitis',
+        },
+        'istaiga': {'ID': 1, 'KODAS': 888, 'PAVADINIMAS': 'Testinė organizacija nr. 1', 'ADRESAS': 'Testinė g. 9'},
+        'kategorijos': [{'ID': 1, 'PAVADINIMAS': 'Gyventojai ir visuomenė'}],
+    })
+    return dataset
+
+
+def measure(name, datasets, encode, decode):
+    start = time.time()
+    contents = [encode(d) for d in datasets]
+    encode_time = time.time() - start
+
+    start = time.time()
+    for content in contents:
+        decode(content)
+    decode_time = time.time() - start
+
+    n_bytes = sum(len(c.encode('utf-8')) for c in contents)
+    print('%-22s %8.0f bytes/object, encode %7.1fus/object, decode %7.1fus/object' % (
+        name + ':',
+        n_bytes / float(len(datasets)),
+        encode_time / len(datasets) * 1e6,
+        decode_time / len(datasets) * 1e6,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--datasets', type=int, default=10000, help='number of datasets')
+    args = parser.parse_args()
+
+    from odgovlt import DatetimeEncoder
+    from odgovlt import decode_content
+    from odgovlt import encode_content
+
+    rand = random.Random(0)
+    datasets = [create_dataset(rand, i) for i in range(args.datasets)]
+
+    measure('json', datasets, lambda d: json.dumps(d, cls=DatetimeEncoder), json.loads)
+    measure('compact', datasets, lambda d: encode_content(d, compress=False), decode_content)
+    measure('compact, compressed', datasets, encode_content, decode_content)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+"""Measure structural diff of large nested dicts.
+
+Benchmark does not need CKAN instance, for example:
+
+    env/bin/python benchmarks/diff.py 100 1000 10000
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import copy
+import timeit
+
+
+def create_object(size):
+    return {
+        'name': 'testine-rinkmena',
+        'title': 'Testinė rinkmena',
+        'extras': [{'key': 'Raktas %d' % i, 'value': 'Reikšmė %d' % i} for i in range(size)],
+        'groups': [{'name': 'testas-%d' % i} for i in range(size)],
+        'resources': [
+            {'url': 'http://www.testas.lt/%d' % i, 'format': 'CSV', 'description': 'Testas nr. %d' % i}
+            for i in range(size)
+        ],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100, help='number of runs of each case')
+    parser.add_argument('sizes', type=int, nargs='*', default=[100, 1000, 10000], help='number of list elements')
+    args = parser.parse_args()
+
+    from odgovlt import get_changes
+    from odgovlt import get_fingerprint
+    from odgovlt import get_patch
+
+    for size in args.sizes:
+        old = create_object(size)
+        equal = copy.deepcopy(old)
+        changed = copy.deepcopy(old)
+        changed['resources'][size // 2]['format'] = 'JSON'
+        removed = copy.deepcopy(old)
+        del removed['groups'][-1]
+
+        cases = [
+            ('fingerprint', lambda: get_fingerprint(equal)),
+            ('equal', lambda: get_changes(equal, old)),
+            ('one value changed', lambda: get_patch(changed, get_changes(changed, old))),
+            ('list element removed', lambda: get_patch(removed, get_changes(removed, old))),
+        ]
+        for name, func in cases:
+            elapsed = timeit.timeit(func, number=args.number) / args.number
+            print('%6d elements, %-22s %10.3fms' % (size, name + ':', elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+"""Compare per-object and batched harvest object creation in gather stage.
+
+Benchmark needs configured CKAN instance, for example:
+
+    env/bin/python benchmarks/gather.py -c development.ini 10000 100000
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from generate import create_source
+
+
+def load_ckan_config(path):
+    from ckan.lib.cli import CkanCommand
+    command = CkanCommand('')
+    command.options = type('Args', (), {'config': path})
+    command._load_config()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default='development.ini', help='CKAN configuration file')
+    parser.add_argument('-b', '--batch-size', type=int, default=1000, help='batch size of batched gather')
+    parser.add_argument('datasets', type=int, nargs='*', default=[10000, 100000], help='number of datasets')
+    args = parser.parse_args()
+
+    load_ckan_config(args.config)
+
+    from ckanext.harvest.tests.factories import HarvestJobObj
+    from ckanext.harvest.tests.factories import HarvestSourceObj
+    from odgovlt import OdgovltHarvester
+
+    tmpdir = tempfile.mkdtemp()
+    for n_datasets in args.datasets:
+        url = create_source(os.path.join(tmpdir, 'source-%d.db' % n_datasets), n_datasets)
+        source = HarvestSourceObj(url=url, source_type='opendata-gov-lt')
+        for batch_size in (1, args.batch_size):
+            source.config = json.dumps({'gather_batch_size': batch_size})
+            source.save()
+            job = HarvestJobObj(source=source, run=False)
+            start = time.time()
+            ids = OdgovltHarvester().gather_stage(job)
+            elapsed = time.time() - start
+            print('%7d datasets, batch size %5d: %8.2fs, %8.0f objects/s' % (
+                len(ids), batch_size, elapsed, len(ids) / elapsed,
+            ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+"""Generate synthetic opendata.gov.lt source database.
+
+Source database is created from ``tests/schema.sql`` as an SQLite file and
+filled with datasets, users, institutions and a category tree, for example:
+
+    env/bin/python benchmarks/generate.py source.db -n 10000 --depth 3 --fanout 5
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import datetime
+import os
+import random
+
+import sqlalchemy as sa
+
+SCHEMA = os.path.join(os.path.dirname(__file__), os.pardir, 'tests', 'schema.sql')
+
+FIRST_NAMES = (
+    'Jonas', 'Petras', 'Antanas', 'Tomas', 'Mindaugas', 'Darius', 'Andrius', 'Vytautas', 'Rūta', 'Asta',
+    'Jurgita', 'Rasa', 'Eglė', 'Inga', 'Aušra', 'Gintarė', 'Žydrūnas', 'Šarūnas', 'Ieva', 'Lina',
+)
+LAST_NAMES = (
+    'Kazlauskas', 'Jankauskas', 'Petrauskas', 'Stankevičius', 'Vasiliauskas', 'Žukauskas', 'Butkus',
+    'Paulauskas', 'Urbonas', 'Kavaliauskas', 'Kazlauskienė', 'Jankauskienė', 'Petrauskienė', 'Šimkutė',
+)
+PLACES = (
+    'Vilniaus', 'Kauno', 'Klaipėdos', 'Šiaulių', 'Panevėžio', 'Alytaus', 'Marijampolės', 'Utenos',
+    'Tauragės', 'Telšių', 'Druskininkų', 'Neringos', 'Visagino', 'Birštono',
+)
+INSTITUTIONS = (
+    'miesto savivaldybė', 'rajono savivaldybė', 'apskrities archyvas', 'regiono aplinkos apsaugos departamentas',
+    'teritorinė ligonių kasa', 'visuomenės sveikatos centras', 'apskrities priešgaisrinė gelbėjimo valdyba',
+    'teritorinė muitinė', 'valstybinė mokesčių inspekcija', 'regioninis valstybės archyvas',
+)
+SUBJECTS = (
+    'gyventojų', 'įmonių', 'mokyklų', 'ligoninių', 'kelių', 'vandens telkinių', 'miškų', 'licencijų',
+    'leidimų', 'statinių', 'transporto priemonių', 'kultūros paveldo objektų', 'saugomų teritorijų',
+    'šilumos tiekėjų', 'viešųjų pirkimų', 'darbo vietų', 'nusikalstamų veikų', 'bibliotekų',
+)
+OBJECTS = (
+    'sąrašas', 'registras', 'duomenys', 'statistika', 'žemėlapis', 'rodikliai', 'ataskaita', 'suvestinė',
+    'klasifikatorius', 'duomenų rinkinys',
+)
+QUALIFIERS = (
+    'pagal savivaldybes', 'pagal amžių ir lytį', 'pagal veiklos rūšis', '%d m.', '%d m. I ketv.',
+    '%d m. II pusm.', 'Lietuvos Respublikoje', 'valstybės lygmeniu', 'ir jų būklė', '(patikslinta)',
+)
+SENTENCES = (
+    'Duomenų rinkinyje pateikiami {subject} duomenys.',
+    'Duomenys atnaujinami kiekvieną ketvirtį pagal registro tvarkytojo pateiktą informaciją.',
+    'Rinkmenoje nurodomi pavadinimai, kodai, adresai ir veiklos teritorijos.',
+    'Informacija skirta visuomenei, mokslininkams ir valstybės institucijoms.',
+    'Duomenys renkami nuo {year} metų ir skelbiami atvirų duomenų portale.',
+    'Kiekvienas įrašas turi unikalų identifikatorių, sutampantį su registro kodu.',
+    'Šaltinis: {place} {institution}.',
+)
+CATEGORIES = (
+    'Aplinka', 'Ekonomika', 'Energetika', 'Finansai', 'Gyventojai ir visuomenė', 'Kultūra', 'Mokslas',
+    'Sveikata', 'Švietimas', 'Teisingumas', 'Transportas', 'Turizmas', 'Valstybės valdymas', 'Žemės ūkis',
+)
+
+
+def choice_text(rand, template):
+    return template % rand.randint(2005, 2017) if '%d' in template else template
+
+
+def generate_title(rand):
+    words = [rand.choice(PLACES) + ' ' + rand.choice(INSTITUTIONS)] if rand.random() < .3 else []
+    words += [rand.choice(SUBJECTS), rand.choice(OBJECTS)]
+    words += [choice_text(rand, rand.choice(QUALIFIERS)) for _ in range(rand.randint(0, 3))]
+    title = ' '.join(words)
+    return title[0].upper() + title[1:]
+
+
+def generate_summary(rand):
+    return ' '.join(
+        rand.choice(SENTENCES).format(
+            subject=rand.choice(SUBJECTS),
+            year=rand.randint(1990, 2017),
+            place=rand.choice(PLACES),
+            institution=rand.choice(INSTITUTIONS),
+        )
+        for _ in range(rand.randint(1, 40))
+    )
+
+
+def generate_keywords(rand):
+    return rand.choice([', ', ',', '; ']).join(
+        rand.choice(SUBJECTS + OBJECTS + PLACES)
+        for _ in range(rand.randint(0, 8))
+    )
+
+
+def generate_categories(depth, fanout):
+    """Return list of (ID, PAVADINIMAS, KATEGORIJA_ID, LYGIS) of category tree."""
+    categories = []
+    parents = [0]
+    for level in range(1, depth + 1):
+        children = []
+        for parent_id in parents:
+            for i in range(fanout):
+                category_id = len(categories) + 1
+                name = CATEGORIES[(category_id - 1) % len(CATEGORIES)]
+                if level > 1:
+                    name = '%s %d' % (name, category_id)
+                categories.append((category_id, name, parent_id, level))
+                children.append(category_id)
+        parents = children
+    return categories
+
+
+def generate(engine, datasets, users=None, institutions=None, depth=3, fanout=4, seed=0):
+    """Fill source database created from tests/schema.sql with synthetic data.
+
+    By default there is one user per 20 datasets and one institution per 50
+    datasets. Each dataset belongs to one to three categories of the lowest
+    level of a category tree with given `depth` and `fanout`.
+    """
+    rand = random.Random(seed)
+    users = users or max(datasets // 20, 1)
+    institutions = institutions or max(datasets // 50, 1)
+    meta = sa.MetaData()
+    meta.reflect(engine, only=['t_user', 't_istaiga', 't_rinkmena', 't_kategorija', 't_kategorija_rinkmena'])
+    t = meta.tables
+
+    with engine.begin() as conn:
+        conn.execute(t['t_istaiga'].insert(), [
+            {
+                'ID': i,
+                'KODAS': str(188600000 + i),
+                'PAVADINIMAS': '%s %s' % (rand.choice(PLACES), rand.choice(INSTITUTIONS)) + (' %d' % i),
+                'ADRESAS': '%s g. %d, %s' % (rand.choice(LAST_NAMES), rand.randint(1, 200), rand.choice(PLACES)),
+            }
+            for i in range(1, institutions + 1)
+        ])
+
+        conn.execute(t['t_user'].insert(), [
+            {
+                'ID': i,
+                'LOGIN': 'user%d' % i,
+                'PASS': '%032x' % rand.getrandbits(128),
+                'FIRST_NAME': rand.choice(FIRST_NAMES),
+                'LAST_NAME': rand.choice(LAST_NAMES),
+                'ISTAIGA_ID': rand.randint(1, institutions),
+                'EMAIL': 'user%d@example.com' % i,
+                'TELEFONAS': '+3706%07d' % rand.randint(0, 9999999),
+            }
+            for i in range(1, users + 1)
+        ])
+
+        categories = generate_categories(depth, fanout)
+        conn.execute(t['t_kategorija'].insert(), [
+            {'ID': i, 'PAVADINIMAS': name, 'KATEGORIJA_ID': parent_id, 'LYGIS': level}
+            for i, name, parent_id, level in categories
+        ])
+        leaves = [i for i, _, _, level in categories if level == depth]
+
+        created = datetime.datetime(2012, 1, 1)
+        batch_size = 10000
+        for start in range(1, datasets + 1, batch_size):
+            ids = range(start, min(start + batch_size, datasets + 1))
+            conn.execute(t['t_rinkmena'].insert(), [
+                {
+                    'ID': i,
+                    'KODAS': 1000000 + i,
+                    'PAVADINIMAS': generate_title(rand),
+                    'SANTRAUKA': generate_summary(rand),
+                    'R_ZODZIAI': generate_keywords(rand),
+                    'USER_ID': rand.randint(1, users),
+                    'istaiga_id': rand.randint(1, institutions),
+                    'K_EMAIL': 'kontaktai%d@example.com' % rand.randint(1, institutions),
+                    'TINKLAPIS': 'http://www.example.com/duomenys/%d' % i,
+                    'STATUSAS': 'U' if rand.random() < .95 else 'N',
+                    'TR_DATA': created + datetime.timedelta(hours=i),
+                    'PUB_DATA': created + datetime.timedelta(hours=i, minutes=30),
+                }
+                for i in ids
+            ])
+            if leaves:
+                conn.execute(t['t_kategorija_rinkmena'].insert(), [
+                    {'KATEGORIJA_ID': category_id, 'RINKMENA_ID': i}
+                    for i in ids
+                    for category_id in rand.sample(leaves, min(rand.randint(1, 3), len(leaves)))
+                ])
+
+
+def create_source(path, datasets, **kwargs):
+    """Create SQLite source database file and return its URL."""
+    if os.path.exists(path):
+        os.remove(path)
+    engine = sa.create_engine('sqlite:///%s' % path)
+    conn = engine.raw_connection()
+    with open(SCHEMA) as f:
+        conn.executescript(f.read())
+    conn.close()
+    generate(engine, datasets, **kwargs)
+    engine.dispose()
+    return 'sqlite:///%s' % path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', help='SQLite database file')
+    parser.add_argument('-n', '--datasets', type=int, default=1000, help='number of datasets')
+    parser.add_argument('-u', '--users', type=int, help='number of users')
+    parser.add_argument('-i', '--institutions', type=int, help='number of institutions')
+    parser.add_argument('--depth', type=int, default=3, help='depth of category tree')
+    parser.add_argument('--fanout', type=int, default=4, help='number of subcategories of each category')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    url = create_source(
+        args.path, args.datasets,
+        users=args.users, institutions=args.institutions, depth=args.depth, fanout=args.fanout, seed=args.seed,
+    )
+    print(url)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+"""Run full harvest of synthetic source databases and report how it scales.
+
+Source databases are generated with ``benchmarks/generate.py`` as SQLite
+files. Benchmark needs configured CKAN instance, but does not need Solr,
+because search indexing is turned off unless ``--solr`` is given, for example:
+
+    env/bin/python benchmarks/harvest.py -c development.ini 1000 10000 100000
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+from generate import create_source
+
+
+def load_ckan_config(path):
+    from ckan.lib.cli import CkanCommand
+    command = CkanCommand('')
+    command.options = type('Args', (), {'config': path})
+    command._load_config()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(round(q * (len(values) - 1)))] if values else 0
+
+
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.count = 0
+        sa.event.listen(engine, 'before_cursor_execute', self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def run(url, n_datasets):
+    from ckan import model
+    from ckanext.harvest import queue as harvest_queue
+    from ckanext.harvest.model import HarvestObject
+    from ckanext.harvest.tests.factories import HarvestJobObj
+    from ckanext.harvest.tests.factories import HarvestSourceObj
+    from odgovlt import OdgovltHarvester
+    from odgovlt import get_job_report
+    from odgovlt import registry
+
+    source = HarvestSourceObj(url=url, source_type='opendata-gov-lt')
+    job = HarvestJobObj(source=source, run=False)
+    harvester = OdgovltHarvester()
+    queries = QueryCounter(registry.get(url, {}).engine)
+
+    start = time.time()
+    obj_ids = harvester.gather_stage(job)
+    gather_time = time.time() - start
+    gather_queries = queries.count
+
+    # Groups are synchronized by gather stage, which times it in job metrics.
+    sync_groups_time = get_job_report(job.id)['timers']['sync_groups']['total']
+
+    latencies = []
+    start = time.time()
+    for obj_id in obj_ids:
+        obj_start = time.time()
+        harvest_queue.fetch_and_import_stages(harvester, HarvestObject.get(obj_id))
+        latencies.append(time.time() - obj_start)
+        model.Session.remove()
+    import_time = time.time() - start
+    import_queries = queries.count - gather_queries
+
+    total_time = gather_time + import_time
+    print('%d datasets in source, %d harvest objects' % (n_datasets, len(obj_ids)))
+    print('  sync_groups: %8.2fs, included in gather' % sync_groups_time)
+    print('  gather:      %8.2fs, %6d source queries, %8.0f datasets/s' % (
+        gather_time, gather_queries, len(obj_ids) / gather_time))
+    print('  import:      %8.2fs, %6d source queries, %8.0f datasets/s, p50 %.1fms, p99 %.1fms' % (
+        import_time, import_queries, len(obj_ids) / import_time if import_time else 0,
+        percentile(latencies, .5) * 1000, percentile(latencies, .99) * 1000))
+    print('  total:       %8.2fs, %8.0f datasets/s, peak RSS %.0fMB' % (
+        total_time, len(obj_ids) / total_time, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', '--config', default='development.ini', help='CKAN configuration file')
+    parser.add_argument('--depth', type=int, default=3, help='depth of category tree')
+    parser.add_argument('--fanout', type=int, default=4, help='number of subcategories of each category')
+    parser.add_argument('--solr', action='store_true', help='index harvested datasets')
+    parser.add_argument('datasets', type=int, nargs='*', default=[1000, 10000, 100000], help='number of datasets')
+    args = parser.parse_args()
+
+    load_ckan_config(args.config)
+
+    import ckan.plugins as p
+    if not args.solr and p.plugin_loaded('synchronous_search'):
+        p.unload('synchronous_search')
+
+    tmpdir = tempfile.mkdtemp()
+    for n_datasets in args.datasets:
+        path = os.path.join(tmpdir, 'source-%d.db' % n_datasets)
+        url = create_source(path, n_datasets, depth=args.depth, fanout=args.fanout)
+        run(url, n_datasets)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+"""Compare uncached and memoized slugify on Lithuanian dataset titles.
+
+Benchmark does not need CKAN instance, for example:
+
+    env/bin/python benchmarks/slugify.py 10000 100000
+
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import random
+import time
+
+WORDS = (
+    'Lietuvos Respublikos valstybės įmonių sąrašas duomenys registras '
+    'savivaldybių gyventojų skaičius pagal amžių lytį ir gyvenamąją vietą '
+    'Radiacinės saugos centro išduotų galiojančių licencijų verstis veikla su '
+    'jonizuojančiosios spinduliuotės šaltiniais Šilumos tiekimo licencijas '
+    'turinčių įmonių keliai eismo intensyvumas aplinkos apsaugos agentūros '
+    'vandens telkinių būklė švietimo įstaigų mokinių ugdymo rezultatai '
+    'sveikatos priežiūros paslaugų teikėjų nacionalinės žemės tarnybos '
+    'kultūros paveldo objektų žemėlapis 2016 m. II ketv. (pataisyta)'
+).split()
+
+
+def create_titles(n_titles, n_distinct, seed=0):
+    rand = random.Random(seed)
+    distinct = [
+        ' '.join(rand.choice(WORDS) for _ in range(rand.randint(2, 20)))
+        for _ in range(n_distinct)
+    ]
+    return [rand.choice(distinct) for _ in range(n_titles)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-l', '--length', type=int, default=42, help='maximum slug length')
+    parser.add_argument('titles', type=int, nargs='*', default=[10000, 100000], help='number of titles')
+    args = parser.parse_args()
+
+    import odgovlt
+
+    for n_titles in args.titles:
+        titles = create_titles(n_titles, max(n_titles // 10, 1))
+
+        start = time.time()
+        expected = [odgovlt._slugify(title, args.length) for title in titles]
+        elapsed_uncached = time.time() - start
+
+        odgovlt._slug_cache.clear()
+        start = time.time()
+        slugs = odgovlt.slugify_many(titles, args.length)
+        elapsed_cold = time.time() - start
+
+        start = time.time()
+        odgovlt.slugify_many(titles, args.length)
+        elapsed_warm = time.time() - start
+
+        assert slugs == expected
+        for name, elapsed in [
+            ('uncached', elapsed_uncached),
+            ('cold cache', elapsed_cold),
+            ('warm cache', elapsed_warm),
+        ]:
+            print('%7d titles, %-12s %8.3fs, %10.0f titles/s' % (n_titles, name + ':', elapsed, n_titles / elapsed))
+
+
+if __name__ == '__main__':
+    main()
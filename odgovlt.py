@@ -1,23 +1,46 @@
 # -*- coding: utf-8 -*-
 
+from __future__ import print_function
 from __future__ import unicode_literals
 
+import base64
+import bisect
 import collections
+import contextlib
 import datetime
+import functools
+import hashlib
 import itertools
 import json
 import logging
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.util
+import os
+import pickle
+import Queue
 import re
-import string
+import sys
+import threading
+import time
+import zlib
 
+import pylons
 import sqlalchemy as sa
 import unidecode
 
 from ckan import model
+from ckan import plugins
+from ckan.lib import search
+from ckan.lib.cli import CkanCommand
 from ckan.logic import NotFound
+from ckan.model.types import make_uuid
 from ckan.plugins import toolkit
+from ckanext.harvest import queue as harvest_queue
 from ckanext.harvest.harvesters.base import HarvesterBase
+from ckanext.harvest.model import HarvestJob
 from ckanext.harvest.model import HarvestObject
+from ckanext.harvest.model import HarvestSource
 from pylons import config
 
 log = logging.getLogger(__name__)
@@ -27,6 +50,14 @@ ADDRESS_KEY = 'Adresas'
 SOURCE_ID_KEY = 'Šaltinio ID'
 SOURCE_NAME = 'Šaltinis'
 SOURCE_IVPK_IRS = 'IVPK IRS'
+CHECKSUM_KEY = 'Kontrolinė suma'
+
+# Source tables used by harvester.
+SOURCE_TABLES = ('t_user', 't_istaiga', 't_rinkmena', 't_kategorija', 't_kategorija_rinkmena')
+
+# Columns of related tables, that are embedded into harvest object content.
+USER_COLUMNS = ('ID', 'LOGIN', 'PASS', 'EMAIL', 'FIRST_NAME', 'LAST_NAME')
+ISTAIGA_COLUMNS = ('ID', 'KODAS', 'PAVADINIMAS', 'ADRESAS')
 
 
 def fixcase(value):
@@ -36,62 +67,435 @@ def fixcase(value):
         return value
 
 
+SLUG_INVALID_CHARS_RE = re.compile(r'[^\w\s-]')
+SLUG_SEPARATORS_RE = re.compile(r'[-\s]+')
+
+# Maximum number of slugs memoized by `slugify`.
+SLUG_CACHE_SIZE = 100000
+_slug_cache = {}
+
+
 def slugify(title=None, length=90):
+    """Return ASCII slug of title, at most `length` characters long.
+
+    Slugs are memoized, because the same titles are slugified for each object
+    on every run.
+    """
+    key = (title, length)
+    slug = _slug_cache.get(key)
+    if slug is None:
+        if len(_slug_cache) >= SLUG_CACHE_SIZE:
+            _slug_cache.clear()
+        slug = _slug_cache[key] = _slugify(title, length)
+    return slug
+
+
+def slugify_many(titles, length=90):
+    """Return list of slugs of given titles."""
+    return [slugify(title, length) for title in titles]
+
+
+def _slugify(title, length):
     if not title:
         return ''
+    slug = str(SLUG_INVALID_CHARS_RE.sub('', unidecode.unidecode(title)).strip().lower())
+    slug = SLUG_SEPARATORS_RE.sub('-', slug)
+    if len(slug) > length:
+        slug = _shorten_slug(slug, length)
+    return slug
 
-    # Replace all non-ascii characters to ascii equivalents.
-    slug = unidecode.unidecode(title)
 
-    # Make slug.
-    slug = str(re.sub(r'[^\w\s-]', '', slug).strip().lower())
-    slug = re.sub(r'[-\s]+', '-', slug)
+def _shorten_slug(slug, length):
+    # Words are taken alternately from the beginning and from the end of the
+    # slug, 60% of words are candidates for the beginning.
+    words = slug.split('-')
+    split = int(len(words) * .6)
+    n_right = len(words) - split
+    order = []
+    for i in range(max(split, n_right)):
+        if i < split:
+            order.append((i, True))
+        if i < n_right:
+            order.append((len(words) - 1 - i, False))
+
+    left = []
+    right = []
+    total = 0
+    for k, (i, is_left) in enumerate(order):
+        if total + len(words[i]) + (k + 1 if k else 0) > length:
+            break
+        (left if is_left else right).append(words[i])
+        total += len(words[i])
+    return '-'.join(left) + '--' + '-'.join(right)
+
+
+def chunks(iterable, size):
+    """Split iterable into lists of at most `size` items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def prefetch(iterable, size=1):
+    """Iterate over `iterable` in a background thread.
+
+    At most `size` items are read ahead, so memory stays bounded when consumer
+    is slower than producer. Errors raised by `iterable` are reraised in the
+    consumer thread.
+    """
+    items = Queue.Queue(size)
+    stopped = threading.Event()
+    metrics = current_metrics()
 
-    # Make sure, that slug is not longer that specied in `length`.
-    if len(slug) > length:
-        left = []
-        right = []
-        words = slug.split('-')
-        split = int(len(words) * .6)
-        index = itertools.izip_longest(
-            ((i, left) for i in range(split)),
-            ((i, right) for i in range(len(words) - 1, split - 1, -1)),
-        )
-        index = (i for i in
-                 itertools.chain.from_iterable(index) if i is not None)
-        total = 0
-        for k, (i, q) in zip(itertools.chain([0], itertools.count(2)), index):
-            if total + len(words[i]) + k > length:
-                break
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+            except Queue.Full:
+                continue
             else:
-                q.append(words[i])
-                total += len(words[i])
-        slug = '-'.join(left) + '--' + '-'.join(right)
+                return True
+        return False
+
+    def produce():
+        try:
+            with collect_metrics(metrics):
+                for item in iterable:
+                    if not put(('item', item)):
+                        return
+        except Exception as e:
+            log.debug('prefetch producer failed', exc_info=True)
+            put(('error', e))
+        else:
+            put(('done', None))
+
+    thread = threading.Thread(target=produce, name='odgovlt-prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            kind, value = items.get()
+            if kind == 'done':
+                return
+            elif kind == 'error':
+                raise value
+            yield value
+    finally:
+        # Stop producer if consumer has stopped early.
+        stopped.set()
+
+
+TAG_SEPARATORS_RE = re.compile(r'\W+', flags=re.UNICODE)
+
+
+# Pylons globals used by CKAN actions, for example `pylons.i18n._` uses
+# translator. Paster commands register them for the main thread only.
+PYLONS_GLOBALS = ('translator', 'c')
+
+
+def get_pylons_globals():
+    """Return Pylons globals registered for current thread."""
+    objs = {}
+    for name in PYLONS_GLOBALS:
+        proxy = getattr(pylons, name)
+        if hasattr(proxy, '_current_obj'):
+            try:
+                objs[name] = proxy._current_obj()
+            except TypeError:
+                # Not registered for this thread.
+                pass
+    return objs
 
-    return slug
+
+@contextlib.contextmanager
+def pylons_globals(objs):
+    """Register Pylons globals returned by `get_pylons_globals` for current thread."""
+    for name, obj in objs.items():
+        getattr(pylons, name)._push_object(obj)
+    try:
+        yield
+    finally:
+        for name, obj in objs.items():
+            getattr(pylons, name)._pop_object(obj)
 
 
 def tagify(tag):
-    spl = re.split(r'\W+', tag, flags=re.UNICODE)
+    spl = TAG_SEPARATORS_RE.split(tag)
     return ' '.join(spl).strip()
 
 
-def get_package_tags(r_zodziai):
-    name_list = []
-    if r_zodziai:
-        tags = map(fixcase,
-                   map(string.strip,
-                       r_zodziai.replace(';', ',').split(',')))
-        for tag in filter(None, tags):
-            name = tagify(tag).lower()
+class TagNormalizer(object):
+    """Convert R_ZODZIAI keyword lists to CKAN tag names.
 
+    Normalized tags are cached by raw keyword for the whole process, because
+    the same keywords are used by many datasets. Rejected keywords are not
+    logged one by one, instead they are counted in a `rejected` counter, if
+    given, and reported with `report_rejected`.
+    """
+
+    def __init__(self, cache_size=100000):
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def normalize_keyword(self, keyword):
+        """Return (tag name, None) or (None, rejection reason) of a keyword."""
+        result = self._cache.get(keyword)
+        if result is None:
+            name = tagify(fixcase(keyword)).lower()
             if len(name) > 100:
-                log.warning("skip very long tag: %r", tag)
+                result = (None, 'very long tag')
             elif len(name) < 2:
-                log.warning("skip too short tag: %r", tag)
+                result = (None, 'too short tag')
             else:
-                name_list.append(name)
-    return name_list
+                result = (name, None)
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[keyword] = result
+        return result
+
+    def normalize(self, r_zodziai, rejected=None):
+        names = []
+        if r_zodziai:
+            for keyword in r_zodziai.replace(';', ',').split(','):
+                keyword = keyword.strip()
+                if not keyword:
+                    continue
+                name, reason = self.normalize_keyword(keyword)
+                if name is not None:
+                    names.append(name)
+                elif rejected is not None:
+                    rejected[(reason, keyword)] += 1
+        return names
+
+    def normalize_many(self, r_zodziai_list, rejected=None):
+        return [self.normalize(r_zodziai, rejected) for r_zodziai in r_zodziai_list]
+
+    def report_rejected(self, rejected, examples=10):
+        """Log one warning with all rejected keywords counted in `rejected`."""
+        if not rejected:
+            return
+        by_reason = collections.defaultdict(list)
+        for (reason, keyword), count in rejected.items():
+            by_reason[reason].append((keyword, count))
+        log.warning('skipped %d tags (%d distinct): %s', sum(rejected.values()), len(rejected), '; '.join(
+            '%s: %s' % (reason, ', '.join(
+                '%r (%d)' % (keyword, count)
+                for keyword, count in sorted(keywords, key=lambda x: (-x[1], x[0]))[:examples]
+            ))
+            for reason, keywords in sorted(by_reason.items())
+        ))
+
+
+tag_normalizer = TagNormalizer()
+
+
+def get_package_tags(r_zodziai):
+    return tag_normalizer.normalize(r_zodziai)
+
+
+def get_user_data(ivpk_user):
+    if ivpk_user:
+        user_data = {
+            'name': slugify(ivpk_user['LOGIN']),
+            # TODO: Passwrods are encoded with md5 hash, I need to look if
+            #       CKAN supports md5 hashed passwords. If not,
+            #       then users will have to change their passwords.
+            'email': ivpk_user['EMAIL'],
+            'password': ivpk_user['PASS'],
+            'fullname': ' '.join([ivpk_user['FIRST_NAME'], ivpk_user['LAST_NAME']]),
+        }
+    else:
+        user_data = {
+            'name': 'unknown',
+            # TODO: What email should I use?
+            'email': 'unknown@example.com',
+            # TODO: Maybe dynamically generate a password?
+            'password': 'secret123',
+            'fullname': 'Unknown User',
+        }
+    return user_data
+
+
+def get_organization_data(organization):
+    if organization:
+        organization_data = {
+            # PAVADINIMAS
+            'name': slugify(organization['PAVADINIMAS']),
+            'title': organization['PAVADINIMAS'],
+
+            'state': 'active',
+
+            'extras': [
+                # ID
+                {'key': SOURCE_ID_KEY, 'value': organization['ID']},
+
+                # KODAS
+                {'key': CODE_KEY, 'value': organization['KODAS']},
+
+                # ADRESAS
+                {'key': ADDRESS_KEY, 'value': organization['ADRESAS']},
+            ],
+        }
+    else:
+        organization_data = {
+            'name': 'unknown',
+            'title': 'Unknown organization',
+            'state': 'active',
+        }
+    return organization_data
+
+
+# Declarative mapping of t_rinkmena columns to package fields. Only mapped
+# columns are read from source database. Each entry is a (column, package
+# field, converter) tuple, converter can be None.
+PACKAGE_FIELDS = (
+    ('PAVADINIMAS', 'name', lambda value: slugify(value, length=42)),
+    ('PAVADINIMAS', 'title', None),
+    ('SANTRAUKA', 'notes', None),
+    ('TINKLAPIS', 'url', None),
+    ('K_EMAIL', 'maintainer_email', None),
+    ('R_ZODZIAI', 'tags', lambda value: [{'name': tag} for tag in get_package_tags(value)]),
+)
+
+# (column, extra key) tuples of t_rinkmena columns stored as package extras.
+PACKAGE_EXTRAS = (
+    ('ID', SOURCE_ID_KEY),
+    ('KODAS', CODE_KEY),
+)
+
+# Columns used to find related user and organization.
+RELATED_COLUMNS = ('USER_ID', 'istaiga_id')
+
+# Columns not used in packages, but included in dataset fingerprint, so that
+# datasets are reimported when they are changed in source.
+CHANGE_TRACKING_COLUMNS = ('TR_DATA', 'PUB_DATA')
+
+# Large text columns are read only for new or changed datasets. Dataset
+# fingerprint includes only MD5 digest of these columns, stored in
+# `<column>_DIGEST` key.
+LARGE_TEXT_COLUMNS = ('SANTRAUKA',)
+
+DATASET_COLUMNS = tuple(collections.OrderedDict.fromkeys(
+    [column for column, _ in PACKAGE_EXTRAS] +
+    [column for column, _, _ in PACKAGE_FIELDS] +
+    list(RELATED_COLUMNS) +
+    list(CHANGE_TRACKING_COLUMNS)
+))
+
+
+def get_package_fields(ivpk_dataset):
+    """Return package fields and extras mapped from dataset columns."""
+    package_dict = {}
+    for column, field, convert in PACKAGE_FIELDS:
+        value = ivpk_dataset[column]
+        package_dict[field] = convert(value) if convert else value
+    extras = [{'key': key, 'value': ivpk_dataset[column]} for column, key in PACKAGE_EXTRAS]
+    return package_dict, extras
+
+
+# Upper bounds, in seconds, of latency histogram buckets. Last bucket counts
+# all longer calls.
+METRICS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics(object):
+    """Counters and timers with latency histograms.
+
+    One instance is shared by all threads working on the same harvest job,
+    recording is a few dict updates under a lock, so metrics are always on.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.timers = {}
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, seconds):
+        bucket = bisect.bisect_left(METRICS_BUCKETS, seconds)
+        with self._lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = {
+                    'count': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                    'buckets': [0] * (len(METRICS_BUCKETS) + 1),
+                }
+            timer['count'] += 1
+            timer['total'] += seconds
+            timer['max'] = max(timer['max'], seconds)
+            timer['buckets'][bucket] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start)
+
+    def merge(self, data):
+        """Add metrics returned by `to_dict` of another instance."""
+        with self._lock:
+            self.counters.update(data.get('counters', {}))
+            for name, other in data.get('timers', {}).items():
+                timer = self.timers.get(name)
+                if timer is None:
+                    self.timers[name] = dict(other, buckets=list(other['buckets']))
+                else:
+                    timer['count'] += other['count']
+                    timer['total'] += other['total']
+                    timer['max'] = max(timer['max'], other['max'])
+                    timer['buckets'] = [a + b for a, b in zip(timer['buckets'], other['buckets'])]
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'timers': {name: dict(timer, buckets=list(timer['buckets'])) for name, timer in self.timers.items()},
+            }
+
+
+_metrics_local = threading.local()
+
+
+def current_metrics():
+    """Return metrics collected by current thread or None."""
+    return getattr(_metrics_local, 'metrics', None)
+
+
+@contextlib.contextmanager
+def collect_metrics(metrics):
+    """Record metrics of current thread into `metrics` within this block."""
+    previous = current_metrics()
+    _metrics_local.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _metrics_local.metrics = previous
+
+
+def metrics_count(name, value=1):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.count(name, value)
+
+
+@contextlib.contextmanager
+def metrics_timer(name):
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+    else:
+        with metrics.timer(name):
+            yield
 
 
 class CkanAPI(object):
@@ -105,57 +509,734 @@ class CkanAPI(object):
     def __getattr__(self, name):
         def wrapper(context=None, **kwargs):
             context = dict(context) if context else dict(self.context)
-            return toolkit.get_action(name)(context, kwargs)
+            with metrics_timer('ckan.' + name):
+                return toolkit.get_action(name)(context, kwargs)
         return wrapper
 
 
-def was_changed(new, old, object_name, path=()):
-    if isinstance(new, dict):
-        for key in new:
-            if was_changed(new[key], old.get(key), object_name, path + (key,)):
-                return True
-    elif isinstance(new, list):
-        for i in range(len(new)):
-            if i >= len(old) or was_changed(new[i], old[i], object_name, path + (i,)):
-                return True
-    elif new != old:
-        log.debug('%s has been changed %r != %r', '.'.join(map(str, path)), new, old)
-        return True
-    return False
+def get_fingerprint(data):
+    """Return checksum of canonical JSON representation of data."""
+    data = json.dumps(data, cls=DatetimeEncoder, sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def get_changes(new, old):
+    """Return sorted list of paths, where `new` differs from `old`.
+
+    Only keys present in `new` dicts are compared, so `old` can be a full
+    CKAN object dict. Lists are compared by element and elements added to or
+    removed from a list are reported by their index.
+
+    Groups and organizations are loaded from CKAN in bulk, so they are
+    compared directly, which is faster than computing fingerprints. Packages
+    are not loaded at all, if their stored checksum has not changed.
+    """
+    return list(_iter_changes(new, old, ()))
+
+
+def _iter_changes(new, old, path):
+    if new == old:
+        return
+    if isinstance(new, dict) and isinstance(old, dict):
+        for key in sorted(new):
+            for change in _iter_changes(new[key], old.get(key), path + (key,)):
+                yield change
+    elif isinstance(new, list) and isinstance(old, list):
+        for i, (a, b) in enumerate(zip(new, old)):
+            for change in _iter_changes(a, b, path + (i,)):
+                yield change
+        for i in range(min(len(new), len(old)), max(len(new), len(old))):
+            yield path + (i,)
+    else:
+        yield path
+
+
+def get_patch(new, changes):
+    """Return patch payload with top level keys of `new` affected by changes.
+
+    CKAN *_patch actions replace top level values, including whole lists, so
+    smaller patch than that is not possible.
+    """
+    if () in changes:
+        return dict(new)
+    return {path[0]: new[path[0]] for path in changes}
+
+
+def log_changes(object_name, changes):
+    for path in changes:
+        log.debug('%s has been changed: %s', object_name, '.'.join(map(str, path)))
+
+
+def get_group_levels(ivpk_groups, root_id=0):
+    """Split category tree into levels by depth.
+
+    `ivpk_groups` is a dict of (name, category) pairs lists by parent id.
+    Returns a list of levels, starting from top level categories, and a list
+    of category id cycles found in the tree. Categories in a cycle and their
+    descendants are not reachable from the root and are not included in the
+    levels.
+    """
+    levels = []
+    level = ivpk_groups.get(root_id, [])
+    while level:
+        levels.append(level)
+        level = [child for _, ivpk_group in level for child in ivpk_groups.get(ivpk_group['ID'], [])]
+
+    reachable = set([root_id])
+    reachable.update(ivpk_group['ID'] for level in levels for _, ivpk_group in level)
+    parents = {
+        ivpk_group['ID']: parent_id
+        for parent_id, children in ivpk_groups.items()
+        for _, ivpk_group in children
+    }
+    cycles = []
+    seen = set(reachable)
+    for group_id in sorted(parents):
+        path = []
+        while group_id not in seen and group_id in parents:
+            seen.add(group_id)
+            path.append(group_id)
+            group_id = parents[group_id]
+        if group_id in path:
+            cycles.append(path[path.index(group_id):])
+    return levels, cycles
 
 
 def extras_to_dict(extras):
     return {x['key']: x['value'] for x in extras}
 
 
+def format_datetime(value):
+    try:
+        return value.strftime('%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        # strftime gives ValueError for 0000-00-00 00:00:00 datetimes.
+        return None
+
+
 class DatetimeEncoder(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, datetime.datetime):
-            try:
-                return obj.strftime('%Y-%m-%dT%H:%M:%S')
-            except ValueError:
-                # strftime gives ValueError for 0000-00-00 00:00:00 datetimes.
-                return None
+            return format_datetime(obj)
         else:
             return super(DatetimeEncoder, obj).default(obj)
 
 
+# Harvest object content is encoded as a prefix with format version followed
+# by JSON list of values in the order of CONTENT_FIELDS. Content without the
+# prefix is plain JSON dict, used before. Plain JSON content gathered before
+# related data were embedded is decoded, but import stage rejects it.
+CONTENT_PREFIX = 'odgovlt:'
+CONTENT_VERSION = 2
+CONTENT_FIELDS_V1 = (
+    'ID', 'KODAS', 'PAVADINIMAS', 'ALT_PAVADINIMAS', 'SANTRAUKA', 'R_ZODZIAI', 'USER_ID', 'istaiga_id',
+    'ISTAIGA_ALT', 'K_TELEFONAS', 'K_EMAIL', 'RUSIS_ID', 'RUSIS_ALT', 'FORMATAS_ID', 'FORMATAS_ALT', 'P_DATA',
+    'KL_P_DATA', 'G_DATA', 'KL_G_DATA', 'ATNAUJINIMAS', 'TINKLAPIS', 'TEIKIMAS', 'PATIKIMUMAS',
+    'PATIK_PRIEZASTYS', 'ISSAMUMAS', 'SUKAUPTA', 'PERDAVIMO_DATA', 'STATUSAS', 'POZYMIS', 'GALIOJA', 'PASTABOS',
+    'TR_DATA', 'PUB_DATA', 'EKSPORTUOTI',
+)
+CONTENT_FIELDS = DATASET_COLUMNS + tuple(column + '_DIGEST' for column in LARGE_TEXT_COLUMNS)
+CONTENT_VERSIONS = {
+    1: CONTENT_FIELDS_V1,
+    2: CONTENT_FIELDS,
+}
+# Related source data embedded into harvest object content.
+EMBEDDED_KEYS = ('user', 'istaiga', 'kategorijos')
+
+_content_keys = frozenset(CONTENT_FIELDS + EMBEDDED_KEYS)
+
+# Text values longer than this are compressed, if compressed value is shorter.
+CONTENT_COMPRESS_SIZE = 512
+
+
+def _compress(value):
+    compressed = base64.b64encode(zlib.compress(value.encode('utf-8'), 9)).decode('ascii')
+    return {'z': compressed} if len(compressed) < len(value) else value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        return zlib.decompress(base64.b64decode(value['z'])).decode('utf-8')
+    return value
+
+
+def encode_content(ivpk_dataset, compress=True):
+    """Encode dataset, with embedded related data, to harvest object content.
+
+    Values are stored in fixed field order without field names, datetimes are
+    stored as strings and large text values are compressed. Decoded dataset
+    is the same as dataset encoded to JSON with `DatetimeEncoder` and decoded
+    back.
+    """
+    values = []
+    missing = []
+    for field in CONTENT_FIELDS:
+        value = ivpk_dataset.get(field)
+        if value is None:
+            if field not in ivpk_dataset:
+                missing.append(field)
+        elif isinstance(value, datetime.datetime):
+            value = format_datetime(value)
+        elif compress and isinstance(value, basestring) and len(value) > CONTENT_COMPRESS_SIZE:
+            value = _compress(value)
+        values.append(value)
+
+    # Columns, that are not known to this content version.
+    other = {}
+    for key in ivpk_dataset.viewkeys() - _content_keys:
+        value = ivpk_dataset[key]
+        other[key] = format_datetime(value) if isinstance(value, datetime.datetime) else value
+
+    user = ivpk_dataset.get('user')
+    istaiga = ivpk_dataset.get('istaiga')
+    data = [
+        values,
+        [user[c] for c in USER_COLUMNS] if user else None,
+        [istaiga[c] for c in ISTAIGA_COLUMNS] if istaiga else None,
+        [[g['ID'], g['PAVADINIMAS']] for g in ivpk_dataset.get('kategorijos', [])],
+        other,
+        missing,
+    ]
+    return '%s%d:%s' % (CONTENT_PREFIX, CONTENT_VERSION, json.dumps(data, separators=(',', ':')))
+
+
+def decode_content(content):
+    """Decode harvest object content, created by `encode_content` or as JSON."""
+    if not content.startswith(CONTENT_PREFIX):
+        return json.loads(content)
+
+    version, data = content[len(CONTENT_PREFIX):].split(':', 1)
+    if int(version) not in CONTENT_VERSIONS:
+        raise ValueError('unknown harvest object content version: %s' % version)
+
+    values, user, istaiga, kategorijos, other, missing = json.loads(data)
+    ivpk_dataset = dict(zip(CONTENT_VERSIONS[int(version)], map(_decode_value, values)))
+    for field in missing:
+        del ivpk_dataset[field]
+    ivpk_dataset.update(other)
+    ivpk_dataset['user'] = dict(zip(USER_COLUMNS, user)) if user is not None else None
+    ivpk_dataset['istaiga'] = dict(zip(ISTAIGA_COLUMNS, istaiga)) if istaiga is not None else None
+    ivpk_dataset['kategorijos'] = [{'ID': i, 'PAVADINIMAS': p} for i, p in kategorijos]
+    return ivpk_dataset
+
+
+# Harvester state is stored in CKAN database, but separately from CKAN tables.
+state_meta = sa.MetaData()
+
+dataset_state_table = sa.Table(
+    'odgovlt_dataset_state', state_meta,
+    sa.Column('source_id', sa.UnicodeText, primary_key=True),
+    sa.Column('dataset_id', sa.UnicodeText, primary_key=True),
+    sa.Column('fingerprint', sa.UnicodeText, nullable=False),
+    sa.Column('updated', sa.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+
+job_metrics_table = sa.Table(
+    'odgovlt_job_metrics', state_meta,
+    sa.Column('job_id', sa.UnicodeText, primary_key=True),
+    # Import workers can save metrics before gather stage sets source id.
+    sa.Column('source_id', sa.UnicodeText),
+    # Set when the finished job is reported, so that it is reported once.
+    sa.Column('reported', sa.DateTime),
+    sa.Column('data', sa.Text, nullable=False),
+    sa.Column('updated', sa.DateTime, nullable=False, default=datetime.datetime.utcnow),
+)
+
+
+# Packages written by import stage, that are not indexed yet, because search
+# indexing is deferred until the end of harvest job.
+pending_index_table = sa.Table(
+    'odgovlt_pending_index', state_meta,
+    sa.Column('job_id', sa.UnicodeText, nullable=False, index=True),
+    sa.Column('source_id', sa.UnicodeText, nullable=False, index=True),
+    sa.Column('package_id', sa.UnicodeText, nullable=False),
+)
+
+
+def setup_state_tables():
+    state_meta.create_all(model.meta.engine, checkfirst=True)
+
+
+def get_dataset_fingerprint(ivpk_dataset):
+    """Return stable checksum of source dataset with all embedded related data.
+
+    Checksum is the same for a dataset returned by `get_ivpk_datasets` and for
+    the same dataset decoded from harvest object content. Large text columns
+    are not included, only their digests, so that fingerprint can be computed
+    before large texts are read.
+    """
+    return get_fingerprint({
+        key: value for key, value in ivpk_dataset.items()
+        if key not in LARGE_TEXT_COLUMNS
+    })
+
+
+def get_text_digest(text):
+    """Return MD5 digest of text, the same as MD5 computed by MySQL."""
+    if text is None:
+        return None
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def get_package_checksum(package_dict):
+    return get_fingerprint(package_dict)
+
+
+def get_package_extra(package_id, key):
+    """Return extra value of an active package or None."""
+    return (
+        model.Session.query(model.PackageExtra.value).
+        join(model.Package, model.Package.id == model.PackageExtra.package_id).
+        filter(model.Package.id == package_id).
+        filter(model.Package.state == 'active').
+        filter(model.PackageExtra.key == key).
+        filter(model.PackageExtra.state == 'active').
+        scalar()
+    )
+
+
+def get_ckan_groups(is_organization=False):
+    """Return all groups or all organizations, including deleted ones.
+
+    Groups are loaded with their active extras and subgroups in two queries
+    and returned as a dict of group dicts by name, with extras as a dict and
+    subgroups (`groups`) as a sorted list of names.
+    """
+    query = (
+        model.Session.query(
+            model.Group.id, model.Group.name, model.Group.title, model.Group.state,
+            model.GroupExtra.key, model.GroupExtra.value,
+        ).
+        outerjoin(model.GroupExtra, sa.and_(
+            model.GroupExtra.group_id == model.Group.id,
+            model.GroupExtra.state == 'active',
+        )).
+        filter(model.Group.is_organization == is_organization)
+    )
+    groups = {}
+    for group_id, name, title, state, key, value in query:
+        group = groups.setdefault(name, {
+            'id': group_id,
+            'name': name,
+            'title': title,
+            'state': state,
+            'extras': {},
+        })
+        if key is not None:
+            group['extras'][key] = value
+
+    parent = sa.orm.aliased(model.Group)
+    child = sa.orm.aliased(model.Group)
+    query = (
+        model.Session.query(parent.name, child.name).
+        join(model.Member, model.Member.group_id == parent.id).
+        join(child, child.id == model.Member.table_id).
+        filter(parent.is_organization == is_organization).
+        filter(model.Member.table_name == 'group').
+        filter(model.Member.state == 'active').
+        order_by(parent.name, child.name)
+    )
+    for parent_name, child_name in query:
+        groups[parent_name].setdefault('groups', []).append(child_name)
+    for group in groups.values():
+        group.setdefault('groups', [])
+
+    return groups
+
+
+def get_harvested_packages():
+    """Return owner organizations of active harvested packages by package id.
+
+    Harvested packages are found by `Šaltinis = IVPK IRS` extra.
+    """
+    query = (
+        model.Session.query(model.Package.id, model.Package.owner_org).
+        join(model.PackageExtra, model.PackageExtra.package_id == model.Package.id).
+        filter(model.Package.state == 'active').
+        filter(model.PackageExtra.key == SOURCE_NAME).
+        filter(model.PackageExtra.value == SOURCE_IVPK_IRS).
+        filter(model.PackageExtra.state == 'active')
+    )
+    return dict(query)
+
+
+def delete_dataset_fingerprints(source_id, dataset_ids):
+    t = dataset_state_table
+    model.Session.execute(t.delete().where(t.c.source_id == source_id).where(t.c.dataset_id.in_(dataset_ids)))
+    model.Session.commit()
+
+
+def get_dataset_fingerprints(source_id):
+    t = dataset_state_table
+    query = sa.select([t.c.dataset_id, t.c.fingerprint]).where(t.c.source_id == source_id)
+    return dict(model.Session.execute(query).fetchall())
+
+
+def save_dataset_fingerprint(source_id, dataset_id, fingerprint):
+    t = dataset_state_table
+    values = {'fingerprint': fingerprint, 'updated': datetime.datetime.utcnow()}
+    result = model.Session.execute(
+        t.update().
+        where(t.c.source_id == source_id).
+        where(t.c.dataset_id == dataset_id).
+        values(**values)
+    )
+    if result.rowcount == 0:
+        model.Session.execute(t.insert().values(source_id=source_id, dataset_id=dataset_id, **values))
+    model.Session.commit()
+
+
+# Import workers save collected metrics at most this often, in seconds.
+METRICS_SAVE_INTERVAL = 10
+
+
+# Metrics collected by this process and not saved yet, by harvest job id.
+_job_metrics = {}
+_job_metrics_lock = threading.Lock()
+_job_metrics_saved = [time.time()]
+
+
+def get_job_metrics(job_id):
+    """Return metrics of this process for a harvest job."""
+    with _job_metrics_lock:
+        metrics = _job_metrics.get(job_id)
+        if metrics is None:
+            metrics = _job_metrics[job_id] = Metrics()
+        return metrics
+
+
+def save_job_metrics(job_id=None, source_id=None):
+    """Add metrics collected by this process to saved metrics of harvest jobs.
+
+    Metrics of all jobs are saved, unless `job_id` is given. Metrics of a job
+    are saved in one `odgovlt_job_metrics` row, shared by gather stage and
+    all import workers. `source_id` is set by gather stage. Report of a job,
+    that has already been reported, is written again with added metrics.
+    """
+    with _job_metrics_lock:
+        if job_id is None:
+            pending = list(_job_metrics.items())
+            _job_metrics.clear()
+            _job_metrics_saved[0] = time.time()
+        else:
+            pending = [(job_id, _job_metrics.pop(job_id, None) or Metrics())]
+
+    t = job_metrics_table
+    reported = []
+    for job_id, metrics in pending:
+        try:
+            with model.meta.engine.begin() as conn:
+                row = conn.execute(
+                    sa.select([t.c.data, t.c.reported]).where(t.c.job_id == job_id).with_for_update()
+                ).fetchone()
+                saved = Metrics()
+                if row is not None:
+                    saved.merge(json.loads(row.data))
+                saved.merge(metrics.to_dict())
+                values = {
+                    'data': json.dumps(saved.to_dict()),
+                    'updated': datetime.datetime.utcnow(),
+                }
+                if source_id is not None:
+                    values['source_id'] = source_id
+                if row is None:
+                    conn.execute(t.insert().values(job_id=job_id, **values))
+                else:
+                    conn.execute(t.update().where(t.c.job_id == job_id).values(**values))
+            if row is not None and row.reported is not None:
+                reported.append(job_id)
+        except Exception:
+            # Metrics must never fail a harvest job.
+            log.warning('failed to save metrics of harvest job %s', job_id, exc_info=True)
+    for job_id in reported:
+        write_job_report(job_id)
+
+
+def get_unreported_jobs(source_id=None):
+    """Return ids of finished harvest jobs with saved, but not reported metrics."""
+    t = job_metrics_table
+    query = (
+        model.Session.query(HarvestJob.id).
+        filter(HarvestJob.status == 'Finished').
+        filter(HarvestJob.id.in_(sa.select([t.c.job_id]).where(t.c.reported == None)))  # noqa
+    )
+    if source_id is not None:
+        query = query.filter(HarvestJob.source_id == source_id)
+    return [job_id for job_id, in query.order_by(HarvestJob.finished)]
+
+
+def claim_job_report(job_id):
+    """Mark harvest job as reported, return False if it already was."""
+    t = job_metrics_table
+    with model.meta.engine.begin() as conn:
+        result = conn.execute(
+            t.update().
+            where(t.c.job_id == job_id).
+            where(t.c.reported == None).  # noqa
+            values(reported=datetime.datetime.utcnow())
+        )
+    return result.rowcount == 1
+
+
+def get_job_report(job_id):
+    """Return saved metrics of a harvest job as a JSON serializable dict."""
+    t = job_metrics_table
+    row = model.meta.engine.execute(sa.select([t]).where(t.c.job_id == job_id)).fetchone()
+    if row is None:
+        return None
+    report = json.loads(row.data)
+    # Harvest objects are counted by their states, because import stage
+    # metrics of other processes might not be saved yet.
+    objects = (
+        model.Session.query(HarvestObject.state, sa.func.count(HarvestObject.id)).
+        filter(HarvestObject.harvest_job_id == job_id).
+        group_by(HarvestObject.state)
+    )
+    report.update({
+        'job_id': job_id,
+        'source_id': row.source_id,
+        'objects': {state: count for state, count in objects},
+        'buckets': list(METRICS_BUCKETS),
+    })
+    return report
+
+
+def write_job_report(job_id):
+    """Log saved metrics of a harvest job as one JSON line.
+
+    If `ckanext.odgovlt.metrics_dir` is set in CKAN configuration, report is
+    also written to `<job id>.json` file in that directory.
+    """
+    try:
+        report = get_job_report(job_id)
+        if report is None:
+            return None
+        data = json.dumps(report, sort_keys=True)
+        log.info('harvest job metrics: %s', data)
+        metrics_dir = config.get('ckanext.odgovlt.metrics_dir')
+        if metrics_dir:
+            if not os.path.isdir(metrics_dir):
+                os.makedirs(metrics_dir)
+            with open(os.path.join(metrics_dir, '%s.json' % job_id), 'w') as f:
+                f.write(data)
+        return report
+    except Exception:
+        log.warning('failed to write metrics of harvest job %s', job_id, exc_info=True)
+        return None
+
+
+# Ids of packages, whose indexing is deferred within `deferred_indexing_scope`
+# of current thread.
+_deferred_indexing_local = threading.local()
+_deferred_indexing_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def deferred_indexing_scope():
+    """Skip synchronous search indexing of packages deferred within this block.
+
+    Block must include commit of the deferred packages, because they are
+    indexed on commit. Nested blocks share packages of the outermost one.
+    """
+    package_ids = getattr(_deferred_indexing_local, 'package_ids', None)
+    if package_ids is not None:
+        yield
+        return
+    _deferred_indexing_local.package_ids = set()
+    try:
+        yield
+    finally:
+        _deferred_indexing_local.package_ids = None
+
+
+def _notify_unless_deferred(notify):
+    @functools.wraps(notify)
+    def wrapper(self, entity, operation):
+        package_ids = getattr(_deferred_indexing_local, 'package_ids', None)
+        if package_ids and isinstance(entity, model.Package) and entity.id in package_ids:
+            return
+        return notify(self, entity, operation)
+    wrapper.odgovlt_deferred = True
+    return wrapper
+
+
+def install_deferred_indexing():
+    """Make synchronous search indexing skip packages deferred by this harvester.
+
+    `synchronous_search` plugin indexes all packages of each committed
+    transaction and CKAN has no context flag to skip it, so `notify` method of
+    `SynchronousSearchPlugin` is wrapped. It is done once per process, by the
+    first import stage with `deferred_indexing` turned on. Wrapper skips only
+    packages added by `defer_package_indexing` within `deferred_indexing_scope`
+    of the current thread, all other packages are indexed as before.
+    """
+    with _deferred_indexing_lock:
+        if getattr(search.SynchronousSearchPlugin.notify, 'odgovlt_deferred', False):
+            return
+        log.info('wrap SynchronousSearchPlugin.notify to skip packages with deferred indexing')
+        search.SynchronousSearchPlugin.notify = _notify_unless_deferred(search.SynchronousSearchPlugin.notify)
+
+
+def defer_package_indexing(source_id, job_id, package_id):
+    """Add package to packages indexed at the end of the job, without committing.
+
+    Package is not indexed when it is committed, if it is written within
+    `deferred_indexing_scope`, after `install_deferred_indexing` was called.
+    """
+    model.Session.execute(pending_index_table.insert().values(
+        job_id=job_id, source_id=source_id, package_id=package_id,
+    ))
+    package_ids = getattr(_deferred_indexing_local, 'package_ids', None)
+    if package_ids is not None:
+        package_ids.add(package_id)
+
+
+def index_pending_packages(job_id=None, source_id=None, batch_size=1000):
+    """Index packages with deferred indexing of a job or of all jobs of a source.
+
+    Packages are sent to Solr in batches of `batch_size` and Solr commit is
+    done once, after all of them are sent. Returns number of indexed packages.
+    """
+    t = pending_index_table
+    where = t.c.job_id == job_id if job_id is not None else t.c.source_id == source_id
+    package_ids = [
+        package_id for package_id, in
+        model.Session.execute(sa.select([t.c.package_id]).where(where).distinct().order_by(t.c.package_id))
+    ]
+    if not package_ids:
+        return 0
+
+    log.info('index %d packages', len(package_ids))
+    package_index = search.index_for(model.Package)
+    context = {'model': model, 'ignore_auth': True, 'validate': False, 'use_cache': False}
+    indexed = 0
+    with metrics_timer('index'):
+        for batch in chunks(package_ids, batch_size):
+            with metrics_timer('index.batch'):
+                for package_id in batch:
+                    try:
+                        package_dict = toolkit.get_action('package_show')(dict(context), {'id': package_id})
+                    except NotFound:
+                        continue
+                    package_index.update_dict(package_dict, defer_commit=True)
+                    indexed += 1
+        search.commit()
+
+    model.Session.execute(t.delete().where(where))
+    model.Session.commit()
+    metrics_count('index.packages', indexed)
+    return indexed
+
+
+def get_schema_fingerprint(engine):
+    """Return checksum of source table definitions.
+
+    Checksum is computed with a single query, but only for MySQL and SQLite,
+    for other databases None is returned.
+    """
+    if engine.dialect.name == 'mysql':
+        columns = sa.Table(
+            'COLUMNS', sa.MetaData(),
+            *[sa.Column(c) for c in (
+                'TABLE_SCHEMA', 'TABLE_NAME', 'COLUMN_NAME', 'ORDINAL_POSITION', 'COLUMN_TYPE',
+                'IS_NULLABLE', 'COLUMN_DEFAULT', 'COLUMN_KEY',
+            )],
+            schema='information_schema'
+        )
+        query = (
+            sa.select([
+                columns.c.TABLE_NAME, columns.c.COLUMN_NAME, columns.c.COLUMN_TYPE,
+                columns.c.IS_NULLABLE, columns.c.COLUMN_DEFAULT, columns.c.COLUMN_KEY,
+            ]).
+            where(columns.c.TABLE_SCHEMA == sa.func.database()).
+            where(columns.c.TABLE_NAME.in_(SOURCE_TABLES)).
+            order_by(columns.c.TABLE_NAME, columns.c.ORDINAL_POSITION)
+        )
+    elif engine.dialect.name == 'sqlite':
+        master = sa.table('sqlite_master', sa.column('name'), sa.column('sql'))
+        query = (
+            sa.select([master.c.name, master.c.sql]).
+            where(master.c.name.in_(SOURCE_TABLES)).
+            order_by(master.c.name)
+        )
+    else:
+        return None
+
+    rows = [tuple(row) for row in engine.execute(query)]
+    return hashlib.sha1(repr(rows).encode('utf-8')).hexdigest()
+
+
+# Reflected source table metadata by (source URL, schema fingerprint).
+_reflected_schemas = {}
+
+
+def reflect_source_tables(engine, cache_dir=None):
+    """Reflect source tables used by harvester.
+
+    Only tables listed in SOURCE_TABLES are reflected. Reflected metadata is
+    cached in memory and, if `cache_dir` is given, pickled to disk. Both caches
+    are keyed by source URL and schema fingerprint, so cached metadata is not
+    used after source schema changes.
+    """
+    fingerprint = get_schema_fingerprint(engine)
+    key = (str(engine.url), fingerprint)
+
+    if key in _reflected_schemas:
+        return _reflected_schemas[key]
+
+    path = None
+    if cache_dir and fingerprint:
+        name = hashlib.sha1('\n'.join(key).encode('utf-8')).hexdigest()
+        path = os.path.join(cache_dir, 'odgovlt-schema-%s.pickle' % name)
+
+    meta = None
+    if path and os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                meta = pickle.load(f)
+        except Exception:
+            log.warning("can't load source schema snapshot from %s", path, exc_info=True)
+        else:
+            meta.bind = engine
+
+    if meta is None:
+        meta = sa.MetaData(bind=engine)
+        meta.reflect(only=SOURCE_TABLES)
+        if path:
+            tmp = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, path)
+
+    _reflected_schemas[key] = meta
+    return meta
+
+
 class IvpkIrsSync(object):
 
     def __init__(self, engine):
         self.engine = engine
-        meta = sa.MetaData(bind=engine)
-        meta.reflect()
-        tables = {
-            'user': meta.tables['t_user'],
-            'istaiga': meta.tables['t_istaiga'],
-            'rinkmena': meta.tables['t_rinkmena'],
-            'kategorija': meta.tables['t_kategorija'],
-            'kategorija_rinkmena': meta.tables['t_kategorija_rinkmena'],
-        }
-        self.t = collections.namedtuple('Tables', tables.keys())(**tables)
-
-        self.api = CkanAPI({'user': self.sync_harvest_user()})
+        self._tables = None
+        self.harvest_user = self.sync_harvest_user()
+        self.api = CkanAPI({'user': self.harvest_user})
+        self.organizations = {}
+
+    @property
+    def t(self):
+        # Tables are reflected lazily, because import stage works only with
+        # harvest object content and should not touch source database.
+        if self._tables is None:
+            meta = reflect_source_tables(self.engine, config.get('ckanext.odgovlt.schema_cache_dir'))
+            tables = {
+                'user': meta.tables['t_user'],
+                'istaiga': meta.tables['t_istaiga'],
+                'rinkmena': meta.tables['t_rinkmena'],
+                'kategorija': meta.tables['t_kategorija'],
+                'kategorija_rinkmena': meta.tables['t_kategorija_rinkmena'],
+            }
+            self._tables = collections.namedtuple('Tables', tables.keys())(**tables)
+        return self._tables
 
     def sync_harvest_user(self):
         name = config.get('ckanext.harvest.user_name') or 'harvest'
@@ -180,169 +1261,628 @@ class IvpkIrsSync(object):
 
         return name
 
-    def sync_user(self, user_id):
-        ivpk_user = self.engine.execute(sa.select([self.t.user]).  where(self.t.user.c.ID == user_id)).fetchone()
-        if ivpk_user:
-            user_data = {
-                'name': slugify(ivpk_user.LOGIN),
-                # TODO: Passwrods are encoded with md5 hash, I need to look if
-                #       CKAN supports md5 hashed passwords. If not,
-                #       then users will have to change their passwords.
-                'email': ivpk_user.EMAIL,
-                'password': ivpk_user.PASS,
-                'fullname': ' '.join([ivpk_user.FIRST_NAME, ivpk_user.LAST_NAME]),
-            }
+    def sync_users(self):
+        """Synchronize all source users and their organization memberships.
+
+        Source users, CKAN users and CKAN organization memberships are read
+        with one query each and only missing users and memberships are
+        created. Each owner of an exported dataset becomes an editor of the
+        dataset organization, existing memberships are not changed.
+
+        Must be called after `sync_organizations`. Returns a map of source
+        user ids to CKAN user names.
+        """
+        ckan_users = set(name for name, in model.Session.query(model.User.name))
+        ckan_members = set(
+            model.Session.query(model.Group.name, model.User.name).
+            join(model.Member, model.Member.group_id == model.Group.id).
+            join(model.User, model.User.id == model.Member.table_id).
+            filter(model.Group.is_organization == True).  # noqa
+            filter(model.Member.table_name == 'user').
+            filter(model.Member.state == 'active')
+        )
+
+        users = {}
+        ivpk_users = {}
+        for ivpk_user in self.engine.execute(sa.select([self.t.user])):
+            user_data = get_user_data(ivpk_user)
+            users[ivpk_user.ID] = user_data['name']
+            ivpk_users[user_data['name']] = user_data
+
+        unknown_user = get_user_data(None)
+        unknown_organization = get_organization_data(None)
+        rinkmena = self.t.rinkmena
+        ivpk_members = set(
+            (
+                self.organizations.get(istaiga_id, unknown_organization['name']),
+                users.get(user_id, unknown_user['name']),
+            )
+            for user_id, istaiga_id in self.engine.execute(
+                sa.select([rinkmena.c.USER_ID, rinkmena.c.istaiga_id]).
+                distinct().
+                where(rinkmena.c.STATUSAS == 'U')
+            )
+        )
+        if any(user_name == unknown_user['name'] for _, user_name in ivpk_members):
+            ivpk_users[unknown_user['name']] = unknown_user
+
+        for name, user_data in sorted(ivpk_users.items()):
+            if name not in ckan_users:
+                log.info('create user: %s', name)
+                self.api.user_create(**user_data)
+
+        for organization_name, user_name in sorted(ivpk_members - ckan_members):
+            log.info('add %s as editor of %s', user_name, organization_name)
+            self.api.organization_member_create(id=organization_name, username=user_name, role='editor')
+
+        return users
+
+    def sync_organizations(self):
+        """Synchronize all source institutions with CKAN organizations.
+
+        All institutions and all CKAN organizations are read with one query
+        each. Missing organizations are created, changed ones are updated and
+        organizations of institutions removed from source are deleted, if
+        they do not have any active datasets left.
+
+        Returns a map of institution ids to organization names, which is also
+        saved as `self.organizations`.
+        """
+        ckan_organizations = get_ckan_groups(is_organization=True)
+
+        organizations = {}
+        ivpk_organizations = {}
+        for ivpk_organization in self.engine.execute(sa.select([self.t.istaiga])):
+            organization_data = get_organization_data(ivpk_organization)
+            organizations[ivpk_organization.ID] = organization_data['name']
+            ivpk_organizations[organization_data['name']] = organization_data
+
+        # Datasets without institution belong to the unknown organization.
+        rinkmena = self.t.rinkmena
+        istaiga = self.t.istaiga
+        has_unknown = self.engine.execute(
+            sa.select([sa.func.count()]).
+            select_from(rinkmena.outerjoin(istaiga, istaiga.c.ID == rinkmena.c.istaiga_id)).
+            where(rinkmena.c.STATUSAS == 'U').
+            where(istaiga.c.ID == None)  # noqa
+        ).scalar()
+        if has_unknown:
+            organization_data = get_organization_data(None)
+            ivpk_organizations[organization_data['name']] = organization_data
+
+        for name, organization_data in sorted(ivpk_organizations.items()):
+            ckan_organization = ckan_organizations.get(name)
+            if ckan_organization is None:
+                log.info('create organization: %s', name)
+                self.api.organization_create(**organization_data)
+                continue
+
+            changes = get_changes(dict(organization_data, extras={
+                x['key']: None if x['value'] is None else '%s' % x['value']
+                for x in organization_data.get('extras', [])
+            }), ckan_organization)
+            if changes:
+                log.info('update organization: %s', name)
+                log_changes('organization ' + name, changes)
+                self.api.organization_patch(id=ckan_organization['id'], **get_patch(organization_data, changes))
+
+        stale_organizations = {
+            ckan_organization['id']: name
+            for name, ckan_organization in ckan_organizations.items()
+            if (
+                name not in ivpk_organizations and
+                ckan_organization['state'] == 'active' and
+                SOURCE_ID_KEY in ckan_organization['extras']
+            )
+        }
+        if stale_organizations:
+            # Deleting an organization also deletes all its datasets, so only
+            # empty organizations are deleted. Datasets of removed
+            # institutions are moved or withdrawn first.
+            not_empty = set(
+                owner_org for owner_org, in (
+                    model.Session.query(model.Package.owner_org).
+                    filter(model.Package.owner_org.in_(stale_organizations)).
+                    filter(model.Package.state == 'active').
+                    distinct()
+                )
+            )
+            for organization_id, name in sorted(stale_organizations.items(), key=lambda x: x[1]):
+                if organization_id in not_empty:
+                    log.info('stale organization still has datasets: %s', name)
+                else:
+                    log.info('delete stale organization: %s', name)
+                    self.api.organization_delete(id=organization_id)
+
+        self.organizations = organizations
+        return organizations
+
+    def get_organization_name(self, ivpk_dataset):
+        """Return CKAN organization name of a dataset without any lookups."""
+        name = self.organizations.get(ivpk_dataset['istaiga_id'])
+        if name is None:
+            # Organizations were synchronized by another process.
+            name = get_organization_data(ivpk_dataset.get('istaiga'))['name']
+        return name
+
+    def sync_group(self, ckan_groups, group_name, ivpk_group, subgroup_names):
+        group_data = {
+            'name': group_name,
+            'title': ivpk_group['PAVADINIMAS'],
+            'extras': [
+                {'key': SOURCE_NAME, 'value': SOURCE_IVPK_IRS},
+                {'key': SOURCE_ID_KEY, 'value': ivpk_group['ID']},
+            ],
+            'groups': [{'name': name} for name in subgroup_names],
+            'state': 'active',
+        }
+
+        if group_name in ckan_groups:
+            # Group is compared with the one loaded by get_ckan_groups, in
+            # the same form: extras as a dict of strings and subgroups as
+            # a sorted list of names.
+            changes = get_changes(dict(group_data, **{
+                'extras': {x['key']: '%s' % x['value'] for x in group_data['extras']},
+                'groups': sorted(subgroup_names),
+            }), ckan_groups[group_name])
+            if changes:
+                log.info('update group: %s', group_name)
+                log_changes('group ' + group_name, changes)
+                self.api.group_patch(id=group_name, **get_patch(group_data, changes))
+            else:
+                log.debug('group is up to date: %s', group_name)
         else:
-            user_data = {
-                'name': 'unknown',
-                # TODO: What email should I use?
-                'email': 'unknown@example.com',
-                # TODO: Maybe dynamically generate a password?
-                'password': 'secret123',
-                'fullname': 'Unknown User',
-            }
+            log.info('create group: %s', group_name)
+            self.api.group_create(**group_data)
+
+    def _sync_group_task(self, metrics, objs, args):
+        # Runs in a worker thread, which gets its own database session and
+        # Pylons globals of the thread, that started the pool.
+        try:
+            with collect_metrics(metrics), pylons_globals(objs):
+                self.sync_group(*args)
+        finally:
+            model.Session.remove()
+
+    def sync_group_tree(self, ckan_groups, ivpk_groups, workers=None):
+        """Create or update groups of the category tree, level by level.
+
+        The deepest level is synchronized first, so subgroups always exist
+        before their parent group refers to them. If `workers` is greater than
+        one, all groups of one level are synchronized concurrently by a pool
+        of `workers` threads.
+        """
+        levels, cycles = get_group_levels(ivpk_groups)
+        for cycle in cycles:
+            log.error('skip categories with cyclic KATEGORIJA_ID: %s', ' -> '.join(map(str, cycle)))
+
+        tasks = [
+            [
+                (ckan_groups, group_name, ivpk_group, [name for name, _ in ivpk_groups[ivpk_group['ID']]])
+                for group_name, ivpk_group in level
+            ]
+            for level in reversed(levels)
+        ]
+        workers = max(workers or 1, 1)
+        if workers == 1:
+            for level in tasks:
+                for args in level:
+                    self.sync_group(*args)
+        else:
+            task = functools.partial(self._sync_group_task, current_metrics(), get_pylons_globals())
+            pool = multiprocessing.pool.ThreadPool(workers)
+            try:
+                for level in tasks:
+                    pool.map(task, level)
+            finally:
+                pool.close()
+                pool.join()
+        return cycles
+
+    def get_group_names(self, ivpk_groups):
+        return slugify_many(ivpk_group['PAVADINIMAS'] + ' ' + str(ivpk_group['ID']) for ivpk_group in ivpk_groups)
+
+    def sync_groups(self, workers=None):
+        # All groups, including deleted ones, are loaded at once and compared
+        # with source categories in memory.
+        ckan_groups = get_ckan_groups()
+        ivpk_group_names = set()
+        ivpk_groups = collections.defaultdict(list)
+
+        rows = self.engine.execute(sa.select([self.t.kategorija])).fetchall()
+        for group_name, ivpk_group in zip(self.get_group_names(rows), rows):
+            ivpk_groups[ivpk_group.KATEGORIJA_ID].append((group_name, ivpk_group))
+            ivpk_group_names.add(group_name)
+
+        self.sync_group_tree(ckan_groups, ivpk_groups, workers)
+
+        for group_name, ckan_group in sorted(ckan_groups.items()):
+            if (
+                group_name not in ivpk_group_names and
+                ckan_group['state'] != 'deleted' and
+                ckan_group['extras'].get(SOURCE_NAME) == SOURCE_IVPK_IRS
+            ):
+                log.info('delete stale group: %s', group_name)
+                self.api.group_delete(id=ckan_group['id'])
+
+    def get_ivpk_dataset_ids(self):
+        """Return ids of all exported source datasets as strings."""
+        rinkmena = self.t.rinkmena
+        query = sa.select([rinkmena.c.ID]).where(rinkmena.c.STATUSAS == 'U')
+        return set('%s' % dataset_id for dataset_id, in self.engine.execute(query))
+
+    def get_vanished_packages(self):
+        """Return harvested packages, whose datasets are not exported anymore.
+
+        Returns a dict of owner organization ids of vanished packages by
+        package id and the number of all harvested packages.
+        """
+        packages = get_harvested_packages()
+        dataset_ids = self.get_ivpk_dataset_ids()
+        vanished = {
+            package_id: owner_org
+            for package_id, owner_org in packages.items()
+            if package_id not in dataset_ids
+        }
+        return vanished, len(packages)
+
+    def withdraw_packages(self, packages, batch_size=100):
+        """Delete packages given as owner organization ids by package id.
+
+        Packages are deleted with one `bulk_update_delete` call per batch of
+        packages of the same organization. `bulk_update_delete` works only
+        within an organization, so packages without one are deleted one by one.
+        """
+        by_organization = collections.defaultdict(list)
+        for package_id, owner_org in packages.items():
+            by_organization[owner_org].append(package_id)
+        for package_id in sorted(by_organization.pop(None, [])):
+            log.info('withdraw package without organization: %s', package_id)
+            self.api.package_delete(id=package_id)
+        for owner_org, package_ids in sorted(by_organization.items()):
+            for batch in chunks(sorted(package_ids), batch_size):
+                log.info('withdraw %d packages of organization %s', len(batch), owner_org)
+                self.api.bulk_update_delete(datasets=batch, org_id=owner_org)
+
+    def get_datasets_groups(self, first_id=None, last_id=None):
+        """Return categories of exported datasets, grouped by dataset id.
+
+        If `first_id` and `last_id` are given, only categories of datasets
+        with ids in that range are returned.
+        """
+        kategorija = self.t.kategorija
+        kategorija_rinkmena = self.t.kategorija_rinkmena
+        rinkmena = self.t.rinkmena
+        query = (
+            sa.select([kategorija_rinkmena.c.RINKMENA_ID, kategorija.c.ID, kategorija.c.PAVADINIMAS]).
+            distinct().
+            select_from(
+                kategorija_rinkmena.
+                join(kategorija, kategorija.c.ID == kategorija_rinkmena.c.KATEGORIJA_ID).
+                join(rinkmena, rinkmena.c.ID == kategorija_rinkmena.c.RINKMENA_ID)
+            ).
+            where(rinkmena.c.STATUSAS == 'U').
+            order_by(kategorija_rinkmena.c.RINKMENA_ID, kategorija.c.ID)
+        )
+        if first_id is not None and last_id is not None:
+            query = query.where(kategorija_rinkmena.c.RINKMENA_ID.between(first_id, last_id))
+        groups = collections.defaultdict(list)
+        for row in self.engine.execute(query):
+            groups[row.RINKMENA_ID].append({'ID': row.ID, 'PAVADINIMAS': row.PAVADINIMAS})
+        return groups
+
+    def get_large_text_digest(self, column):
+        # MySQL and PostgreSQL compute MD5 on the server, so large texts of
+        # unchanged datasets are not transferred. Other databases have no
+        # hash function, there texts are read and hashed by `get_text_digest`.
+        if self.engine.dialect.name in ('mysql', 'postgresql'):
+            return sa.func.md5(column)
+        else:
+            return None
+
+    def get_ivpk_dataset_chunks(self, chunk_size=1000, after_id=None, fingerprints=None):
+        """Yield exported datasets together with all related source data.
+
+        Each dataset is a dict of `DATASET_COLUMNS` of `t_rinkmena` with owner
+        user (`user`), organization (`istaiga`) and categories (`kategorijos`)
+        embedded, so that import stage does not need to query source database.
+
+        Datasets are read in lists of at most `chunk_size` datasets, using
+        keyset pagination on `ID`, so only one chunk is held in memory. If
+        `after_id` is given, only datasets with greater ids are returned.
+
+        If `fingerprints` of previously imported datasets are given, large
+        text columns are read only for datasets with a different fingerprint.
+        """
+        rinkmena = self.t.rinkmena
+        user = self.t.user
+        istaiga = self.t.istaiga
+        columns = [c for c in DATASET_COLUMNS if c in rinkmena.c and c not in LARGE_TEXT_COLUMNS]
+        large_text_columns = [c for c in LARGE_TEXT_COLUMNS if c in rinkmena.c]
+        digests = [self.get_large_text_digest(rinkmena.c[c]) for c in large_text_columns]
+        server_digest = all(digest is not None for digest in digests)
+        query = (
+            sa.select(
+                [rinkmena.c[c] for c in columns] +
+                (
+                    [digest.label(c + '_DIGEST') for c, digest in zip(large_text_columns, digests)]
+                    if server_digest else
+                    [rinkmena.c[c] for c in large_text_columns]
+                ) +
+                [user.c[c].label('user_' + c) for c in USER_COLUMNS] +
+                [istaiga.c[c].label('istaiga_' + c) for c in ISTAIGA_COLUMNS]
+            ).
+            select_from(
+                rinkmena.
+                outerjoin(user, user.c.ID == rinkmena.c.USER_ID).
+                outerjoin(istaiga, istaiga.c.ID == rinkmena.c.istaiga_id)
+            ).
+            where(rinkmena.c.STATUSAS == 'U').
+            order_by(rinkmena.c.ID).
+            limit(chunk_size)
+        )
 
-        ckan_user = next((
-            u for u in self.api.user_list(q=user_data['name'])
-            if u['name'] == user_data['name']
-        ), None)
+        last_id = after_id
+        while True:
+            chunk_query = query if last_id is None else query.where(rinkmena.c.ID > last_id)
+            rows = self.engine.execute(chunk_query).fetchall()
+            metrics_count('source.datasets', len(rows))
+            if not rows:
+                return
+
+            groups = self.get_datasets_groups(rows[0]['ID'], rows[-1]['ID'])
+            chunk = []
+            for row in rows:
+                ivpk_dataset = {c: row[c] for c in columns}
+                for c in large_text_columns:
+                    if server_digest:
+                        ivpk_dataset[c + '_DIGEST'] = row[c + '_DIGEST']
+                    else:
+                        ivpk_dataset[c + '_DIGEST'] = get_text_digest(row[c])
+                ivpk_dataset['user'] = (
+                    {c: row['user_' + c] for c in USER_COLUMNS}
+                    if row['user_ID'] is not None else None
+                )
+                ivpk_dataset['istaiga'] = (
+                    {c: row['istaiga_' + c] for c in ISTAIGA_COLUMNS}
+                    if row['istaiga_ID'] is not None else None
+                )
+                ivpk_dataset['kategorijos'] = groups.get(ivpk_dataset['ID'], [])
+                chunk.append(ivpk_dataset)
+
+            if large_text_columns:
+                changed = {
+                    ivpk_dataset['ID']: ivpk_dataset
+                    for ivpk_dataset in chunk
+                    if fingerprints is None or
+                    fingerprints.get(str(ivpk_dataset['ID'])) != get_dataset_fingerprint(ivpk_dataset)
+                }
+                if changed and server_digest:
+                    texts = self.engine.execute(
+                        sa.select([rinkmena.c.ID] + [rinkmena.c[c] for c in large_text_columns]).
+                        where(rinkmena.c.ID.in_(changed))
+                    )
+                elif changed:
+                    # Texts were already read to compute digests, only those
+                    # of changed datasets are kept.
+                    texts = (row for row in rows if row['ID'] in changed)
+                else:
+                    texts = []
+                for row in texts:
+                    changed[row['ID']].update((c, row[c]) for c in large_text_columns)
 
-        if ckan_user is None:
-            ckan_user = self.api.user_create(**user_data)
+            yield chunk
 
-        user_data['id'] = ckan_user['id']
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1]['ID']
 
-        return user_data
+    def get_ivpk_datasets(self, chunk_size=1000):
+        for chunk in self.get_ivpk_dataset_chunks(chunk_size):
+            for ivpk_dataset in chunk:
+                yield ivpk_dataset
 
-    def sync_organization(self, istaiga_id):
-        organization = self.engine.execute(
-            sa.select([self.t.istaiga]).
-            where(self.t.istaiga.c.ID == istaiga_id)
-        ).fetchone()
 
-        if organization:
-            organization_data = {
-                # PAVADINIMAS
-                'name': slugify(organization.PAVADINIMAS),
-                'title': organization.PAVADINIMAS,
+def create_source_engine(url, options=None):
+    """Create pooled source database engine.
 
-                'state': 'active',
+    Pool is configured using `pool_size` and `pool_recycle` harvest source
+    configuration options. MySQL closes idle connections after `wait_timeout`,
+    so connections are recycled every hour by default.
+    """
+    options = options or {}
+    kwargs = {'pool_recycle': options.get('pool_recycle', 3600)}
+    if options.get('pool_size'):
+        kwargs['pool_size'] = options['pool_size']
+    engine = sa.create_engine(url, **kwargs)
+    sa.event.listen(engine, 'before_cursor_execute', _before_source_query)
+    sa.event.listen(engine, 'after_cursor_execute', _after_source_query)
+    return engine
 
-                'extras': [
-                    # ID
-                    {'key': SOURCE_ID_KEY, 'value': organization.ID},
 
-                    # KODAS
-                    {'key': CODE_KEY, 'value': organization.KODAS},
+def _before_source_query(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.odgovlt_start = time.time()
 
-                    # ADRESAS
-                    {'key': ADDRESS_KEY, 'value': organization.ADRESAS},
-                ],
-            }
-        else:
-            organization_data = {
-                'name': 'unknown',
-                'title': 'Unknown organization',
-                'state': 'active',
-            }
 
-        try:
-            ckan_organization = self.api.organization_show(id=organization_data['name'])
-        except NotFound:
-            ckan_organization = None
-
-        if ckan_organization is None:
-            ckan_organization = self.api.organization_create(**organization_data)
-
-        organization_data['id'] = ckan_organization['id']
-        return organization_data
-
-    def sync_group_tree(self, ckan_group_names, ivpk_groups, ivpk_parent_group_id=0):
-        for group_name, ivpk_group in ivpk_groups[ivpk_parent_group_id]:
-            group_data = {
-                'name': group_name,
-                'title': ivpk_group.PAVADINIMAS,
-                'extras': [
-                    {'key': SOURCE_NAME, 'value': SOURCE_IVPK_IRS},
-                    {'key': SOURCE_ID_KEY, 'value': ivpk_group.ID},
-                ],
-                'groups': [
-                    {'name': ckan_group['name']}
-                    for ckan_group in self.sync_group_tree(ckan_group_names, ivpk_groups, ivpk_group.ID)
-                ],
-                'state': 'active',
-            }
+def _after_source_query(conn, cursor, statement, parameters, context, executemany):
+    # Source queries are counted and timed in metrics of current job.
+    metrics = current_metrics()
+    if metrics is not None and context is not None:
+        metrics.observe('source.query', time.time() - context.odgovlt_start)
 
-            if group_name in ckan_group_names:
-                ckan_group = self.api.group_show(id=group_name)
-                if was_changed(group_data, ckan_group, 'group'):
-                    group_data['id'] = group_name
-                    log.info('update group: %s', group_name)
-                    ckan_group = self.api.group_patch(**group_data)
-                else:
-                    log.debug('group is up to date: %s', group_name)
-                yield ckan_group
-            else:
-                log.info('create group: %s', group_name)
-                yield self.api.group_create(**group_data)
-
-    def _get_group_name(self, ivpk_group):
-        return slugify(ivpk_group.PAVADINIMAS + ' ' + str(ivpk_group.ID))
-
-    def sync_groups(self):
-        # We can't use api.group_list, becuase we also need list of deleted groups.
-        ckan_group_names = set(
-            group_name
-            for group_name, in (
-                model.Session.query(model.Group.name).
-                filter(model.Group.is_organization == False)  # noqa
-            )
-        )
-        ivpk_group_names = set()
-        ivpk_groups = collections.defaultdict(list)
 
-        for ivpk_group in self.engine.execute(sa.select([self.t.kategorija])):
-            group_name = self._get_group_name(ivpk_group)
-            ivpk_groups[ivpk_group.KATEGORIJA_ID].append((group_name, ivpk_group))
-            ivpk_group_names.add(group_name)
+SourceEntry = collections.namedtuple('SourceEntry', ('options', 'engine', 'sync'))
 
-        for _ in self.sync_group_tree(ckan_group_names, ivpk_groups):
-            pass
 
-        stale_ckan_groups = ckan_group_names - ivpk_group_names
-        for group_name in stale_ckan_groups:
-            ckan_group = self.api.group_show(id=group_name)
-            ckan_group_extras = extras_to_dict(ckan_group['extras'])
-            if ckan_group_extras.get(SOURCE_NAME) == SOURCE_IVPK_IRS:
-                log.info('delete stale group: %s', ckan_group['name'])
-                self.api.group_delete(id=ckan_group['id'])
+class SourceRegistry(object):
+    """Process wide registry of source engines and IvpkIrsSync instances.
 
-    def get_package_groups(self, dataset_id):
-        dataset_ivpk_group_ids = set([
-            row.KATEGORIJA_ID
-            for row in self.engine.execute(
-                sa.select([self.t.kategorija_rinkmena]).
-                where(self.t.kategorija_rinkmena.c.RINKMENA_ID == dataset_id)
-            )
-        ])
+    Entries are keyed by source URL, so all harvest objects of a source share
+    one connection pool and one already resolved harvest user. If source
+    configuration changes, old entry is dropped and its pool is disposed.
+    """
 
-        for ivpk_group_id in dataset_ivpk_group_ids:
-            ivpk_group = self.engine.execute(
-                sa.select([self.t.kategorija]).
-                where(self.t.kategorija.c.ID == ivpk_group_id)
-            ).first()
-            yield self._get_group_name(ivpk_group)
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, url, options=None):
+        options = options or {}
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None and entry.options != options:
+                log.info('source configuration has been changed, recreate source engine')
+                self._remove(url)
+                entry = None
+            if entry is None:
+                engine = create_source_engine(url, options)
+                entry = self._entries[url] = SourceEntry(options, engine, IvpkIrsSync(engine))
+            return entry.sync
+
+    def invalidate(self, url=None):
+        with self._lock:
+            for key in ([url] if url else list(self._entries)):
+                self._remove(key)
+
+    def _remove(self, url):
+        entry = self._entries.pop(url, None)
+        if entry is not None:
+            entry.engine.dispose()
+
+
+registry = SourceRegistry()
+
+# Harvest source configuration options and their types.
+CONFIG_OPTIONS = {
+    'pool_size': (int, 'an integer'),
+    'pool_recycle': (int, 'an integer'),
+    'incremental': (bool, 'a boolean'),
+    'gather_batch_size': (int, 'an integer'),
+    'source_chunk_size': (int, 'an integer'),
+    'group_workers': (int, 'an integer'),
+    'withdraw_threshold': ((int, float), 'a number'),
+    'withdraw_batch_size': (int, 'an integer'),
+    'deferred_indexing': (bool, 'a boolean'),
+}
+
+# Number of vanished datasets, that are withdrawn regardless of
+# `withdraw_threshold`, so that small sources can lose a few datasets.
+WITHDRAW_UNCHECKED = 10
+
+
+def _init_import_worker():
+    # Metrics not saved yet are saved when worker process exits.
+    multiprocessing.util.Finalize(None, save_job_metrics, exitpriority=10)
+
+
+def _import_worker(harvest_object_id):
+    try:
+        obj = HarvestObject.get(harvest_object_id)
+        harvest_queue.fetch_and_import_stages(OdgovltHarvester(), obj)
+        return harvest_object_id, obj.state
+    except Exception:
+        log.exception('import of harvest object %s failed', harvest_object_id)
+        return harvest_object_id, 'ERROR'
+    finally:
+        model.Session.remove()
+
+
+def _import_chunk_worker(harvest_object_ids):
+    return dict(_import_worker(obj_id) for obj_id in harvest_object_ids)
+
+
+class ImportPipeline(object):
+    """Import harvest objects by a pool of worker processes as they are submitted.
+
+    Each worker process has its own CKAN database session and source engine,
+    so pipeline must be created before any CKAN objects are loaded.
+
+    At most `queue_size` tasks (default: two per worker) are submitted and
+    not finished yet, `submit` blocks until the oldest one is finished, so
+    that gather stage, which submits harvest objects, does not read source
+    much faster than workers import them.
+    """
 
-    def get_ivpk_datasets(self):
-        query = (
-            sa.select([self.t.rinkmena]).
-            where(self.t.rinkmena.c.STATUSAS == 'U')
-        )
-        for ivpk_dataset in self.engine.execute(query):
-            yield ivpk_dataset
+    def __init__(self, workers=None, queue_size=None):
+        # Pooled connections must not be inherited by forked worker processes,
+        # so each worker opens its own CKAN and source database connections.
+        model.Session.remove()
+        model.meta.engine.dispose()
+        registry.invalidate()
+
+        workers = workers or multiprocessing.cpu_count()
+        self.queue_size = max(queue_size or workers * 2, 1)
+        self.states = {}
+        self._pending = collections.deque()
+        self._pool = multiprocessing.Pool(workers, _init_import_worker)
+
+    def submit(self, harvest_object_ids):
+        """Queue committed harvest objects for import."""
+        for task in chunks(harvest_object_ids, 10):
+            if len(self._pending) >= self.queue_size:
+                with metrics_timer('gather.queue_wait'):
+                    while len(self._pending) >= self.queue_size:
+                        self.states.update(self._pending.popleft().get())
+            self._pending.append(self._pool.apply_async(_import_chunk_worker, (task,)))
+
+    def join(self):
+        """Wait until all submitted harvest objects are imported.
+
+        Returns harvest object states by harvest object id.
+        """
+        while self._pending:
+            self.states.update(self._pending.popleft().get())
+        self._pool.close()
+        self._pool.join()
+        return self.states
+
+    def terminate(self):
+        self._pool.terminate()
+
+
+def import_harvest_objects(harvest_object_ids, workers=None):
+    """Fetch and import harvest objects using a pool of worker processes.
+
+    Returns harvest object states by harvest object id.
+    """
+    pipeline = ImportPipeline(workers)
+    try:
+        pipeline.submit(harvest_object_ids)
+        return pipeline.join()
+    finally:
+        pipeline.terminate()
+
+
+@toolkit.chained_action
+def harvest_jobs_run(original_action, context, data_dict):
+    """Finish jobs of this harvester, that `harvest_jobs_run` has marked as finished.
+
+    `harvest_jobs_run` marks a job as finished, when all its harvest objects
+    are complete or errored, no matter how many fetch consumers imported them.
+    """
+    result = original_action(context, data_dict)
+    setup_state_tables()
+    harvester = OdgovltHarvester()
+    for job_id in get_unreported_jobs(data_dict.get('source_id')):
+        harvester.finish_job(job_id)
+    return result
 
 
 class OdgovltHarvester(HarvesterBase):
+    plugins.implements(plugins.IActions)
+
+    # Set by `harvest_objects_import` action, so that packages are written
+    # even if they have not changed.
+    force_import = False
+
+    # If set, gather stage calls it with ids of each committed batch of
+    # harvest objects, so that they are imported while source is still
+    # being read, see `ImportPipeline.submit`.
+    gathered = None
+
+    def get_actions(self):
+        return {'harvest_jobs_run': harvest_jobs_run}
 
     def info(self):
         return {
@@ -352,18 +1892,155 @@ class OdgovltHarvester(HarvesterBase):
             'form_config_interface': 'Text',
         }
 
+    def validate_config(self, config):
+        if not config:
+            return config
+
+        try:
+            config_obj = json.loads(config)
+        except ValueError as e:
+            raise ValueError('Unable to parse config: %s' % e)
+
+        for key, (type_, type_name) in CONFIG_OPTIONS.items():
+            if key in config_obj and not isinstance(config_obj[key], type_):
+                raise ValueError('%s must be %s' % (key, type_name))
+
+        return config
+
+    def _set_config(self, config_str):
+        self.config = json.loads(config_str) if config_str else {}
+
+    def _get_sync(self, source):
+        self._set_config(source.config)
+        return registry.get(source.url, self.config)
+
     def gather_stage(self, harvest_object):
         log.debug('In OdgovltHarvester gather_stage')
 
-        sync = IvpkIrsSync(sa.create_engine(harvest_object.source.url))
-        sync.sync_groups()
+        # Metrics of gather stage are saved when it is done, job is reported
+        # by `harvest_jobs_run`, when all harvest objects are imported.
+        setup_state_tables()
+        job_id = harvest_object.id
+        metrics = get_job_metrics(job_id)
+        with collect_metrics(metrics), metrics.timer('gather'):
+            ids = self._gather_stage(harvest_object)
+        metrics.count('gather.objects', len(ids))
+        save_job_metrics(job_id, harvest_object.source.id)
+        return ids
 
-        ids = []
-        for ivpk_dataset in sync.get_ivpk_datasets():
-            content = json.dumps(dict(ivpk_dataset), cls=DatetimeEncoder)
-            obj = HarvestObject(guid=ivpk_dataset.ID, job=harvest_object, content=content)
-            obj.save()
-            ids.append(obj.id)
+    def finish_job(self, job_id):
+        """Index packages with deferred indexing and write job report.
+
+        Does nothing and returns False, if the job has already been finished.
+        """
+        save_job_metrics(job_id)
+        if not claim_job_report(job_id):
+            return False
+        with collect_metrics(get_job_metrics(job_id)):
+            index_pending_packages(job_id)
+        # Job is already marked as reported, so saving metrics writes report.
+        save_job_metrics(job_id)
+        return True
+
+    def _gather_stage(self, harvest_object):
+        sync = self._get_sync(harvest_object.source)
+
+        # Packages of previous jobs, that were not finished, are indexed now.
+        index_pending_packages(source_id=harvest_object.source.id)
+
+        # Packages of datasets, that are not exported anymore, are withdrawn
+        # before anything else is synchronized, so that a broken source,
+        # which suddenly lost many datasets, stops the job before it changes
+        # anything.
+        with metrics_timer('withdraw'):
+            vanished, harvested = sync.get_vanished_packages()
+            threshold = self.config.get('withdraw_threshold', 0.2)
+            if len(vanished) > WITHDRAW_UNCHECKED and len(vanished) > threshold * harvested:
+                message = (
+                    '%d of %d harvested datasets are not exported by the source anymore, that is more than '
+                    'withdraw_threshold (%s), harvest job is aborted' % (len(vanished), harvested, threshold)
+                )
+                log.error(message)
+                self._save_gather_error(message, harvest_object)
+                return []
+            if vanished:
+                sync.withdraw_packages(vanished, max(self.config.get('withdraw_batch_size', 100), 1))
+                delete_dataset_fingerprints(harvest_object.source.id, list(vanished))
+                metrics_count('withdrawn', len(vanished))
+
+        with metrics_timer('sync_groups'):
+            sync.sync_groups(self.config.get('group_workers'))
+        with metrics_timer('sync_organizations'):
+            sync.sync_organizations()
+        with metrics_timer('sync_users'):
+            sync.sync_users()
+
+        # In incremental mode, harvest objects are created only for new
+        # datasets and for datasets changed since last successful import.
+        incremental = self.config.get('incremental', False)
+        fingerprints = get_dataset_fingerprints(harvest_object.source.id) if incremental else {}
+
+        # If gather stage of this job was interrupted, continue after the last
+        # dataset, that already has a harvest object. Resume point is derived
+        # from saved harvest objects, because `harvest_queue.gather_stage`
+        # deletes all harvest objects of the job, if gather stage fails, and
+        # then gather must start from the beginning.
+        existing = (
+            model.Session.query(HarvestObject.id, HarvestObject.guid).
+            filter(HarvestObject.harvest_job_id == harvest_object.id).
+            order_by(HarvestObject.gathered, HarvestObject.id).
+            all()
+        )
+        ids = [obj_id for obj_id, guid in existing]
+        last_id = max(int(guid) for obj_id, guid in existing) if existing else None
+        if existing:
+            log.info('resume gather stage after dataset %s, %d harvest objects already created', last_id, len(ids))
+            if self.gathered is not None:
+                self.gathered(list(ids))
+
+        # Harvest objects are saved in batches with one commit per batch. Ids
+        # are generated here, because after commit objects are expired and
+        # reading obj.id would reload each object from database.
+        unchanged = 0
+        batch_size = max(self.config.get('gather_batch_size', 1000), 1)
+        chunk_size = max(self.config.get('source_chunk_size', 1000), 1)
+
+        # Source is read in chunks by a background thread, so next chunk is
+        # being read while harvest objects of previous one are being saved.
+        ivpk_dataset_chunks = sync.get_ivpk_dataset_chunks(
+            chunk_size, after_id=last_id, fingerprints=fingerprints if incremental else None,
+        )
+        ivpk_datasets = itertools.chain.from_iterable(prefetch(ivpk_dataset_chunks, size=2))
+        rejected_tags = collections.Counter()
+        for chunk in chunks(ivpk_datasets, batch_size):
+            # Tags of all datasets are normalized here in batches, so that
+            # import stage finds them in the cache and rejected tags are
+            # reported once per job.
+            tag_normalizer.normalize_many((d['R_ZODZIAI'] for d in chunk), rejected_tags)
+
+            objs = []
+            for ivpk_dataset in chunk:
+                if incremental and fingerprints.get(str(ivpk_dataset['ID'])) == get_dataset_fingerprint(ivpk_dataset):
+                    unchanged += 1
+                    continue
+                objs.append(HarvestObject(
+                    id=make_uuid(),
+                    guid=ivpk_dataset['ID'],
+                    job=harvest_object,
+                    source=harvest_object.source,
+                    content=encode_content(ivpk_dataset),
+                ))
+            batch_ids = [obj.id for obj in objs]
+            ids.extend(batch_ids)
+            model.Session.add_all(objs)
+            model.Session.commit()
+            if batch_ids and self.gathered is not None:
+                self.gathered(batch_ids)
+
+        tag_normalizer.report_rejected(rejected_tags)
+        metrics_count('gather.unchanged', unchanged)
+        if incremental:
+            log.info('%d new or changed datasets, %d unchanged datasets skipped', len(ids), unchanged)
         return ids
 
     def fetch_stage(self, harvest_object):
@@ -373,35 +2050,145 @@ class OdgovltHarvester(HarvesterBase):
     def import_stage(self, harvest_object):
         log.debug('In OdgovltHarvester import_stage')
 
-        sync = IvpkIrsSync(sa.create_engine(harvest_object.source.url))
-
-        ivpk_dataset = json.loads(harvest_object.content)
-        user = sync.sync_user(ivpk_dataset['USER_ID'])
-        organization = sync.sync_organization(ivpk_dataset['istaiga_id'])
-        sync.api.organization_member_create(id=organization['name'], username=user['name'], role='editor')
+        job_id = harvest_object.harvest_job_id
+        metrics = get_job_metrics(job_id)
+        result = False
+        try:
+            with collect_metrics(metrics), metrics.timer('import'), deferred_indexing_scope():
+                result = self._import_stage(harvest_object)
+            return result
+        finally:
+            metrics.count('import.' + (
+                'unchanged' if result == 'unchanged' else
+                'written' if result else
+                'errors'
+            ))
+            self._object_imported(job_id)
+
+    def _object_imported(self, job_id):
+        # Imported harvest objects are counted in memory and saved with other
+        # metrics periodically.
+        if time.time() - _job_metrics_saved[0] > METRICS_SAVE_INTERVAL:
+            save_job_metrics()
+
+    def _import_stage(self, harvest_object):
+        sync = self._get_sync(harvest_object.source)
+        deferred_indexing = self.config.get('deferred_indexing', False)
+        if deferred_indexing:
+            install_deferred_indexing()
+
+        # All source data are embedded into harvest object content and users,
+        # organizations and memberships are synchronized by gather stage, so
+        # here we do not query source database or look up related objects.
+        ivpk_dataset = decode_content(harvest_object.content)
+        if not all(key in ivpk_dataset for key in EMBEDDED_KEYS):
+            # Content gathered before related data were embedded would turn
+            # into a package of unknown user and organization without groups.
+            self._save_object_error(
+                'Harvest object content has no embedded source user, institution and categories',
+                harvest_object, 'Import',
+            )
+            return False
+        user = get_user_data(ivpk_dataset.get('user'))
+        organization_name = sync.get_organization_name(ivpk_dataset)
 
-        package_dict = {
+        package_dict, extras = get_package_fields(ivpk_dataset)
+        package_dict.update({
             'id': harvest_object.guid,
-            'name': slugify(ivpk_dataset['PAVADINIMAS'], length=42),
-            'title': ivpk_dataset['PAVADINIMAS'],
-            'notes': ivpk_dataset['SANTRAUKA'],
-            'url': ivpk_dataset['TINKLAPIS'],
             'maintainer': user['fullname'],
-            'maintainer_email': ivpk_dataset['K_EMAIL'],
-            'owner_org': organization['name'],
+            'owner_org': organization_name,
             'state': 'active',
-            'tags': [
-                {'name': tag}
-                for tag in get_package_tags(ivpk_dataset['R_ZODZIAI'])
-            ],
             'groups': [
-                {'name': ckan_group_name}
-                for ckan_group_name in sync.get_package_groups(ivpk_dataset['ID'])
-            ],
-            'extras': [
-                {'key': SOURCE_NAME, 'value': SOURCE_IVPK_IRS},
-                {'key': SOURCE_ID_KEY, 'value': ivpk_dataset['ID']},
-                {'key': CODE_KEY, 'value': ivpk_dataset['KODAS']},
+                {'name': group_name}
+                for group_name in sync.get_group_names(ivpk_dataset.get('kategorijos', []))
             ],
-        }
-        return self._create_or_update_package(package_dict, harvest_object, package_dict_form='package_show')
+            'extras': [{'key': SOURCE_NAME, 'value': SOURCE_IVPK_IRS}] + extras,
+        })
+
+        # Package is written only if it differs from the previously imported
+        # one, because each write creates a revision and reindexes package.
+        checksum = get_package_checksum(package_dict)
+        package_dict['extras'].append({'key': CHECKSUM_KEY, 'value': checksum})
+        if (
+            not (self.force_import or getattr(harvest_object, 'force_import', False)) and
+            get_package_extra(harvest_object.guid, CHECKSUM_KEY) == checksum
+        ):
+            log.debug('package is up to date: %s', harvest_object.guid)
+            result = 'unchanged'
+        else:
+            if deferred_indexing:
+                # Package is added to pending ones before it is written,
+                # because it is indexed on commit.
+                defer_package_indexing(harvest_object.source.id, harvest_object.harvest_job_id, harvest_object.guid)
+            with metrics_timer('import.write'):
+                result = self._create_or_update_package(package_dict, harvest_object, package_dict_form='package_show')
+
+        if result:
+            save_dataset_fingerprint(harvest_object.source.id, harvest_object.guid,
+                                     get_dataset_fingerprint(ivpk_dataset))
+        return result
+
+
+class OdgovltCommand(CkanCommand):
+    """Harvest opendata.gov.lt using parallel import workers
+
+    Usage:
+
+        odgovlt run <source-id> [--workers=N] [--queue-size=N]
+            Run harvest job for given harvest source. Harvest objects are
+            imported by N worker processes (default: number of CPUs), while
+            gather stage is still reading source. Gather stage waits if N import
+            tasks (default: two per worker) are not finished yet.
+
+    """
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 2
+    max_args = 2
+
+    def __init__(self, name):
+        super(OdgovltCommand, self).__init__(name)
+        self.parser.add_option('-w', '--workers', dest='workers', type='int', default=None,
+                               help='number of import worker processes')
+        self.parser.add_option('-q', '--queue-size', dest='queue_size', type='int', default=None,
+                               help='number of import tasks waiting for workers')
+
+    def command(self):
+        self._load_config()
+
+        cmd, source_id = self.args
+        if cmd != 'run':
+            print(self.usage)
+            sys.exit(1)
+
+        # Workers are forked before anything is loaded from CKAN database.
+        pipeline = ImportPipeline(self.options.workers, self.options.queue_size)
+        try:
+            source = HarvestSource.get(source_id)
+            if source is None:
+                print('Harvest source %s not found.' % source_id)
+                sys.exit(1)
+
+            job = HarvestJob(source=source, status='Running')
+            job.save()
+
+            # Harvest objects are imported by workers as soon as gather stage
+            # commits them, so source is read while CKAN is being written.
+            harvester = OdgovltHarvester()
+            harvester.gathered = pipeline.submit
+            try:
+                harvest_queue.gather_stage(harvester, job)
+            finally:
+                # Harvester is a singleton plugin, so it must not keep
+                # submitting to the pipeline after this command.
+                harvester.gathered = None
+            states = pipeline.join()
+        finally:
+            pipeline.terminate()
+
+        # Workers save their metrics when they exit, so job is finished and
+        # reported with complete metrics.
+        toolkit.get_action('harvest_jobs_run')({'model': model, 'ignore_auth': True}, {'source_id': source.id})
+
+        for state, count in sorted(collections.Counter(states.values()).items()):
+            print('%s: %d' % (state, count))
@@ -21,6 +21,9 @@ setup(
     entry_points={
         'ckan.plugins': [
             'odgovlt_harvester=odgovlt:OdgovltHarvester',
-        ]
+        ],
+        'paste.paster_command': [
+            'odgovlt=odgovlt:OdgovltCommand',
+        ],
     },
 )
@@ -2,39 +2,74 @@
 
 from __future__ import unicode_literals
 
+import collections
 import contextlib
+import datetime
 import gettext
+import hashlib
+import itertools
 import json
 import logging
 import os
+import random
+import re
 
 import mock
+import paste.registry
 import pkg_resources as pres
 import psycopg2
 import psycopg2.extensions
 import pylons
 import pytest
 import sqlalchemy as sa
+import unidecode
 import webtest
 
 import ckan.config.middleware
 import ckan.lib.search.index
 import ckan.model
 import ckanext.harvest.model
+from ckan.plugins import toolkit
 from ckan.tests.helpers import reset_db
+from ckanext.harvest import queue as harvest_queue
 from ckanext.harvest.harvesters.ckanharvester import CKANHarvester
 from ckanext.harvest.tests.factories import HarvestJobObj
 from ckanext.harvest.tests.factories import HarvestObjectObj
 from ckanext.harvest.tests.factories import HarvestSourceObj
 from ckanext.harvest.tests.lib import run_harvest
+from ckanext.harvest.tests.lib import run_harvest_job
 
+import odgovlt
+from odgovlt import CONTENT_FIELDS_V1
+from odgovlt import DATASET_COLUMNS
 from odgovlt import CkanAPI
 from odgovlt import DatetimeEncoder
 from odgovlt import OdgovltHarvester
+from odgovlt import decode_content
+from odgovlt import encode_content
 from odgovlt import fixcase
+from odgovlt import get_changes
+from odgovlt import get_dataset_fingerprint
+from odgovlt import get_group_levels
+from odgovlt import get_harvested_packages
+from odgovlt import get_job_report
+from odgovlt import get_organization_data
+from odgovlt import get_patch
 from odgovlt import get_package_tags
+from odgovlt import get_user_data
+from odgovlt import ImportPipeline
+from odgovlt import import_harvest_objects
+from odgovlt import prefetch
 from odgovlt import slugify
+from odgovlt import slugify_many
 from odgovlt import IvpkIrsSync
+from odgovlt import SourceRegistry
+from odgovlt import TagNormalizer
+from odgovlt import SOURCE_IVPK_IRS
+from odgovlt import SOURCE_NAME
+from odgovlt import SOURCE_TABLES
+from odgovlt import reflect_source_tables
+from odgovlt import registry
 
 
 class CKANTestApp(webtest.TestApp):
@@ -66,7 +101,13 @@ def was_last_job_considered_error_free():
 
 @pytest.fixture
 def db():
-    engine = sa.create_engine('sqlite://')
+    # Source database is also read from a background thread in gather stage,
+    # so all threads must share the same in-memory database.
+    engine = sa.create_engine(
+        'sqlite://',
+        connect_args={'check_same_thread': False},
+        poolclass=sa.pool.StaticPool,
+    )
 
     with open(os.path.join(os.path.dirname(__file__), 'schema.sql')) as f:
         engine.raw_connection().executescript(f.read())
@@ -114,6 +155,9 @@ def app(postgres, mocker, caplog):
 
     pylons.translator = gettext.NullTranslations()
 
+    # Cached harvest user does not survive database reset.
+    registry.invalidate()
+
     return app
 
 
@@ -259,35 +303,15 @@ def test_OdgovltHarvester(app, db, mocker):
     assert subgroups('testas6-6') == []
     assert subgroups('testas7-7') == []
 
-    assert [json.loads(ckanext.harvest.model.HarvestObject.get(x).content)['PAVADINIMAS'] for x in obj_ids] == [
+    assert [decode_content(ckanext.harvest.model.HarvestObject.get(x).content)['PAVADINIMAS'] for x in obj_ids] == [
         'Testinė rinkmena nr. 1',
         'Testinė rinkmena nr. 2',
     ]
-    database_data_list = [dict(row) for row in db.execute(sync.t.rinkmena.select())]
-    user1 = sync.sync_user(1)
-    user2 = sync.sync_user(2)
-    user3 = sync.sync_user(3)
-    database_data_list[0]['VARDAS'] = user1['fullname']
-    database_data_list[1]['VARDAS'] = user2['fullname']
-    organization1 = sync.sync_organization(1)
-    organization2 = sync.sync_organization(2)
-    organization3 = sync.sync_organization(3)
-    database_data_list[0]['ORGANIZACIJA'] = organization1['name']
-    database_data_list[1]['ORGANIZACIJA'] = organization2['name']
-    database_data_list[0]['KATEGORIJA_RINKMENA'] = json.dumps([
-        {
-            'ID': 1,
-            'KATEGORIJA_ID': 1,
-            'RINKMENA_ID': 1,
-        }
-    ])
-    database_data_list[1]['KATEGORIJA_RINKMENA'] = json.dumps([
-        {
-            'ID': 2,
-            'KATEGORIJA_ID': 1,
-            'RINKMENA_ID': 2,
-        }
-    ])
+    database_data_list = list(sync.get_ivpk_datasets())
+    assert database_data_list[0]['user']['LOGIN'] == 'User1'
+    assert database_data_list[1]['istaiga']['PAVADINIMAS'] == 'Testinė organizacija nr. 2'
+    assert database_data_list[0]['kategorijos'] == [{'ID': 1, 'PAVADINIMAS': 'testas1'}]
+    assert database_data_list[1]['kategorijos'] == [{'ID': 3, 'PAVADINIMAS': 'testas3'}]
     obj1 = HarvestObjectObj(
         guid=database_data_list[0]['ID'],
         job=job,
@@ -309,6 +333,7 @@ def test_OdgovltHarvester(app, db, mocker):
     assert obj1.package_id
     assert obj2.package_id
     reset_db()
+    registry.invalidate()
     sync = IvpkIrsSync(db)
     mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
     results_by_guid = run_harvest(url='sqlite://', harvester=OdgovltHarvester())
@@ -357,8 +382,8 @@ def test_OdgovltHarvester(app, db, mocker):
             'name': 'testas3-3',
         }
     ]
-    assert user3['fullname'] == 'Unknown User'
-    assert organization3['title'] == 'Unknown organization'
+    assert get_user_data(None)['fullname'] == 'Unknown User'
+    assert get_organization_data(None)['title'] == 'Unknown organization'
     fixcase_test = fixcase('Testas9')
     assert fixcase_test == 'testas9'
     tags_test = get_package_tags(
@@ -388,6 +413,880 @@ def test_OdgovltHarvester(app, db, mocker):
     ]
 
 
+def test_import_stage_does_not_query_source(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    db.execute(sync.t.user.insert(), {
+        'LOGIN': 'User1',
+        'PASS': 'secret123',
+        'EMAIL': 'testas1@testas1.com',
+        'TELEFONAS': '+37000000000',
+        'FIRST_NAME': 'Jonas',
+        'LAST_NAME': 'Jonaitis',
+    })
+    db.execute(sync.t.istaiga.insert(), {
+        'PAVADINIMAS': 'Testinė organizacija nr. 1',
+        'KODAS': 888,
+        'ADRESAS': 'Testinė g. 9'
+    })
+    db.execute(sync.t.kategorija.insert(), {
+        'PAVADINIMAS': 'testas1',
+        'KATEGORIJA_ID': 0,
+        'LYGIS': 1
+    })
+    for i in range(1, 4):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'R_ZODZIAI': 'keliai,eismo intensyvumas',
+            'STATUSAS': 'U',
+            'USER_ID': 1,
+            'istaiga_id': 1,
+        })
+        db.execute(sync.t.kategorija_rinkmena.insert(), {
+            'KATEGORIJA_ID': 1,
+            'RINKMENA_ID': i
+        })
+
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt')
+    job = HarvestJobObj(source=source)
+    harvester = OdgovltHarvester()
+    obj_ids = harvester.gather_stage(job)
+    assert len(obj_ids) == 3
+
+    queries = []
+    sa.event.listen(db, 'before_cursor_execute', lambda conn, cursor, statement, *args: queries.append(statement))
+    for obj_id in obj_ids:
+        assert harvester.import_stage(ckanext.harvest.model.HarvestObject.get(obj_id))
+    assert queries == []
+
+    ckanapi = CkanAPI({'user': 'harvest'})
+    package = ckanapi.package_show(id='1')
+    assert package['maintainer'] == 'Jonas Jonaitis'
+    assert package['organization']['title'] == 'Testinė organizacija nr. 1'
+    assert [g['name'] for g in package['groups']] == ['testas1-1']
+
+
+def test_import_stage_skips_unchanged_packages(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    db.execute(sync.t.rinkmena.insert(), {
+        'PAVADINIMAS': 'Testinė rinkmena nr. 1',
+        'SANTRAUKA': 'Testas nr. 1',
+        'STATUSAS': 'U',
+    })
+
+    ckanapi = CkanAPI({'user': 'harvest'})
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt')
+    harvester = OdgovltHarvester()
+
+    def harvest():
+        return run_harvest_job(HarvestJobObj(source=source, run=False), harvester)['1']
+
+    assert harvest()['report_status'] == 'added'
+    metadata_modified = ckanapi.package_show(id='1')['metadata_modified']
+
+    result = harvest()
+    assert result['state'] == 'COMPLETE'
+    assert result['report_status'] == 'not modified'
+    assert ckanapi.package_show(id='1')['metadata_modified'] == metadata_modified
+
+    db.execute(sync.t.rinkmena.update(), {'SANTRAUKA': 'Testas nr. 2'})
+    assert harvest()['report_status'] == 'updated'
+    assert ckanapi.package_show(id='1')['notes'] == 'Testas nr. 2'
+    metadata_modified = ckanapi.package_show(id='1')['metadata_modified']
+
+    # Unchanged packages are written by `paster harvester import`.
+    try:
+        ckanapi.harvest_objects_import(source_id=source.id)
+    finally:
+        harvester.force_import = False
+    assert ckanapi.package_show(id='1')['metadata_modified'] > metadata_modified
+
+
+def test_import_stage_rejects_content_without_related_data(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    db.execute(sync.t.istaiga.insert(), {
+        'PAVADINIMAS': 'Testinė organizacija nr. 1',
+        'KODAS': 888,
+        'ADRESAS': 'Testinė g. 9'
+    })
+    db.execute(sync.t.rinkmena.insert(), {
+        'PAVADINIMAS': 'Testinė rinkmena nr. 1',
+        'STATUSAS': 'U',
+        'istaiga_id': 1,
+    })
+
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt')
+    harvester = OdgovltHarvester()
+    assert run_harvest_job(HarvestJobObj(source=source, run=False), harvester)['1']['report_status'] == 'added'
+
+    # Plain JSON content of harvest objects gathered by old versions has no
+    # related source data and must not overwrite the package.
+    ivpk_dataset = next(iter(sync.get_ivpk_datasets()))
+    for key in ('user', 'istaiga', 'kategorijos'):
+        del ivpk_dataset[key]
+    ivpk_dataset['SANTRAUKA'] = 'Pakeista'
+    obj = HarvestObjectObj(
+        guid='1',
+        job=HarvestJobObj(source=source, run=False),
+        content=json.dumps(ivpk_dataset, cls=DatetimeEncoder),
+    )
+    assert not harvester.import_stage(obj)
+    assert [(e.stage, e.message) for e in obj.errors] == [
+        ('Import', 'Harvest object content has no embedded source user, institution and categories'),
+    ]
+
+    package = CkanAPI({'user': 'harvest'}).package_show(id='1')
+    assert package['organization']['title'] == 'Testinė organizacija nr. 1'
+    assert package['notes'] != 'Pakeista'
+
+
+def test_gather_stage_batches(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    for i in range(1, 6):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+        })
+
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt', config='{"gather_batch_size": 2}')
+    job = HarvestJobObj(source=source)
+    commit = mocker.spy(ckan.model.Session, 'commit')
+    obj_ids = OdgovltHarvester().gather_stage(job)
+    assert commit.call_count == 3
+
+    objs = [ckanext.harvest.model.HarvestObject.get(x) for x in obj_ids]
+    assert [obj.guid for obj in objs] == ['1', '2', '3', '4', '5']
+    assert all(obj.harvest_source_id == source.id for obj in objs)
+    assert all(obj.harvest_job_id == job.id for obj in objs)
+
+
+def test_get_ivpk_dataset_chunks(app, db):
+    sync = IvpkIrsSync(db)
+    db.execute(sync.t.kategorija.insert(), {'PAVADINIMAS': 'testas1', 'KATEGORIJA_ID': 0})
+    for i in range(1, 6):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U' if i != 3 else 'N',
+        })
+        db.execute(sync.t.kategorija_rinkmena.insert(), {'KATEGORIJA_ID': 1, 'RINKMENA_ID': i})
+
+    assert [[d['ID'] for d in chunk] for chunk in sync.get_ivpk_dataset_chunks(2)] == [[1, 2], [4, 5]]
+    assert [d['kategorijos'] for d in sync.get_ivpk_datasets(2)] == [[{'ID': 1, 'PAVADINIMAS': 'testas1'}]] * 4
+
+
+def test_get_ivpk_dataset_chunks_projection(app, db):
+    sync = IvpkIrsSync(db)
+    for i in range(1, 4):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'ALT_PAVADINIMAS': 'Nenaudojamas stulpelis',
+            'SANTRAUKA': 'Testas nr. %d' % i,
+            'STATUSAS': 'U',
+        })
+
+    datasets = list(sync.get_ivpk_datasets())
+    assert sorted(datasets[0]) == sorted(DATASET_COLUMNS + ('SANTRAUKA_DIGEST', 'user', 'istaiga', 'kategorijos'))
+    assert [d['SANTRAUKA'] for d in datasets] == ['Testas nr. 1', 'Testas nr. 2', 'Testas nr. 3']
+
+    # Large text is read only for datasets with changed fingerprint.
+    fingerprints = {str(d['ID']): get_dataset_fingerprint(d) for d in datasets}
+    db.execute(sync.t.rinkmena.update().where(sync.t.rinkmena.c.ID == 2), {'SANTRAUKA': 'Pakeistas testas'})
+    datasets = [d for chunk in sync.get_ivpk_dataset_chunks(fingerprints=fingerprints) for d in chunk]
+    assert [d.get('SANTRAUKA') for d in datasets] == [None, 'Pakeistas testas', None]
+    assert [get_dataset_fingerprint(d) == fingerprints[str(d['ID'])] for d in datasets] == [True, False, True]
+
+    # Digest is a real hash, so change of large text, that does not change
+    # its length, changes fingerprint too.
+    db.execute(sync.t.rinkmena.update().where(sync.t.rinkmena.c.ID == 3), {'SANTRAUKA': 'Testas nr. 9'})
+    datasets = [d for chunk in sync.get_ivpk_dataset_chunks(fingerprints=fingerprints) for d in chunk]
+    assert [d.get('SANTRAUKA') for d in datasets] == [None, 'Pakeistas testas', 'Testas nr. 9']
+    assert datasets[2]['SANTRAUKA_DIGEST'] == hashlib.md5('Testas nr. 9'.encode('utf-8')).hexdigest()
+
+
+def test_prefetch():
+    assert list(prefetch(iter(range(10)), size=2)) == list(range(10))
+
+    def failing():
+        yield 1
+        raise ValueError('source error')
+
+    items = prefetch(failing())
+    assert next(items) == 1
+    with pytest.raises(ValueError):
+        next(items)
+
+
+def test_sync_groups(app, db):
+    sync = IvpkIrsSync(db)
+    ckanapi = CkanAPI({'user': 'harvest'})
+
+    for name, parent_id in [('testas1', 0), ('testas2', 1), ('testas3', 1), ('testas4', 0)]:
+        db.execute(sync.t.kategorija.insert(), {
+            'PAVADINIMAS': name,
+            'KATEGORIJA_ID': parent_id,
+        })
+    sync.sync_groups(workers=2)
+    assert ckanapi.group_list() == ['testas1-1', 'testas2-2', 'testas3-3', 'testas4-4']
+    assert [g['name'] for g in ckanapi.group_show(id='testas1-1')['groups']] == ['testas2-2', 'testas3-3']
+
+    # Groups are compared in memory and nothing is written, when groups are
+    # up to date.
+    api = sync.api
+    sync.api = mock.Mock(wraps=api)
+    sync.sync_groups()
+    assert sync.api.group_show.call_count == 0
+    assert sync.api.group_create.call_count == 0
+    assert sync.api.group_patch.call_count == 0
+    assert sync.api.group_delete.call_count == 0
+    sync.api = api
+
+    db.execute(sync.t.kategorija.update().where(sync.t.kategorija.c.ID == 2), {'KATEGORIJA_ID': 4})
+    db.execute(sync.t.kategorija.delete().where(sync.t.kategorija.c.ID == 3))
+    sync.sync_groups()
+    assert ckanapi.group_list() == ['testas1-1', 'testas2-2', 'testas4-4']
+    assert [g['name'] for g in ckanapi.group_show(id='testas1-1')['groups']] == []
+    assert [g['name'] for g in ckanapi.group_show(id='testas4-4')['groups']] == ['testas2-2']
+
+
+def test_sync_groups_threads(app, db, mocker):
+    # Paster commands register translator for the main thread only, while
+    # `app` fixture replaces it with a global one.
+    translator = paste.registry.StackedObjectProxy(name='translator')
+    translator._push_object(gettext.NullTranslations())
+    mocker.patch('pylons.translator', translator)
+
+    sync = IvpkIrsSync(db)
+    for name, parent_id in [('testas1', 0), ('testas2', 1), ('testas3', 1), ('testas4', 1)]:
+        db.execute(sync.t.kategorija.insert(), {
+            'PAVADINIMAS': name,
+            'KATEGORIJA_ID': parent_id,
+        })
+    sync.sync_groups(workers=3)
+
+    ckanapi = CkanAPI({'user': 'harvest'})
+    assert ckanapi.group_list() == ['testas1-1', 'testas2-2', 'testas3-3', 'testas4-4']
+    assert [g['name'] for g in ckanapi.group_show(id='testas1-1')['groups']] == ['testas2-2', 'testas3-3', 'testas4-4']
+
+
+def test_encode_content():
+    ivpk_dataset = {
+        'ID': 1,
+        'PAVADINIMAS': 'Testinė rinkmena nr. 1',
+        'SANTRAUKA': 'Testinės rinkmenos aprašymas. ' * 100,
+        'R_ZODZIAI': None,
+        'TR_DATA': datetime.datetime(2017, 1, 2, 3, 4, 5),
+        'PUB_DATA': datetime.datetime(1, 1, 1),
+        'NAUJAS_STULPELIS': 'x',
+        'user': None,
+        'istaiga': {'ID': 1, 'KODAS': 888, 'PAVADINIMAS': 'Testinė organizacija nr. 1', 'ADRESAS': None},
+        'kategorijos': [{'ID': 1, 'PAVADINIMAS': 'testas1'}],
+    }
+    expected = json.loads(json.dumps(ivpk_dataset, cls=DatetimeEncoder))
+    assert expected['PUB_DATA'] is None
+
+    content = encode_content(ivpk_dataset)
+    assert content.startswith('odgovlt:2:')
+    assert 'Testinės rinkmenos aprašymas' not in content
+    assert len(content) < len(json.dumps(ivpk_dataset, cls=DatetimeEncoder)) / 4
+    assert decode_content(content) == expected
+    assert decode_content(encode_content(ivpk_dataset, compress=False)) == expected
+
+    # Content created by previous versions is plain JSON.
+    assert decode_content(json.dumps(ivpk_dataset, cls=DatetimeEncoder)) == expected
+
+    # Content of previous format version.
+    content = 'odgovlt:1:' + json.dumps([[1] + [None] * (len(CONTENT_FIELDS_V1) - 1), None, None, [], {}, []])
+    assert decode_content(content) == dict(
+        {field: None for field in CONTENT_FIELDS_V1},
+        ID=1, user=None, istaiga=None, kategorijos=[],
+    )
+
+    with pytest.raises(ValueError):
+        decode_content('odgovlt:999:[]')
+
+
+def test_get_changes():
+    old = {
+        'id': 'abc',
+        'title': 'Testas',
+        'extras': [{'key': 'a', 'value': '1'}, {'key': 'b', 'value': '2'}],
+        'groups': ['testas1', 'testas2'],
+    }
+    new = {
+        'title': 'Testas',
+        'extras': [{'key': 'a', 'value': '1'}, {'key': 'b', 'value': '2'}],
+        'groups': ['testas1', 'testas2'],
+    }
+    assert get_changes(new, old) == []
+    assert get_changes(dict(new, title='Kitas'), old) == [('title',)]
+    assert get_changes(dict(new, extras=[{'key': 'a', 'value': '3'}]), old) == [
+        ('extras', 0, 'value'),
+        ('extras', 1),
+    ]
+    assert get_changes(dict(new, groups=['testas1', 'testas2', 'testas3']), old) == [('groups', 2)]
+    assert get_changes(dict(new, title='Kitas'), None) == [()]
+
+    changes = get_changes(dict(new, title='Kitas', groups=[]), old)
+    assert get_patch(dict(new, title='Kitas', groups=[]), changes) == {'title': 'Kitas', 'groups': []}
+    assert get_patch(new, [()]) == new
+
+
+def test_get_group_levels():
+    categories = [
+        (1, 0), (2, 0), (3, 1), (4, 3), (5, 2),
+        # Orphan category.
+        (6, 99),
+        # Cycle with a descendant.
+        (7, 8), (8, 9), (9, 7), (10, 9),
+    ]
+    ivpk_groups = {}
+    for group_id, parent_id in categories:
+        ivpk_groups.setdefault(parent_id, []).append(('testas%d' % group_id, {'ID': group_id}))
+
+    levels, cycles = get_group_levels(ivpk_groups)
+    assert [[name for name, _ in level] for level in levels] == [
+        ['testas1', 'testas2'],
+        ['testas3', 'testas5'],
+        ['testas4'],
+    ]
+    assert cycles == [[7, 8, 9]]
+
+
+def test_sync_organizations(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    ckanapi = CkanAPI({'user': 'harvest'})
+
+    for i in range(1, 4):
+        db.execute(sync.t.istaiga.insert(), {
+            'PAVADINIMAS': 'Testinė organizacija nr. %d' % i,
+            'KODAS': 880 + i,
+            'ADRESAS': 'Testinė g. %d' % i,
+        })
+
+    assert sync.sync_organizations() == {
+        1: 'testine-organizacija-nr-1',
+        2: 'testine-organizacija-nr-2',
+        3: 'testine-organizacija-nr-3',
+    }
+    assert ckanapi.organization_list() == [
+        'testine-organizacija-nr-1',
+        'testine-organizacija-nr-2',
+        'testine-organizacija-nr-3',
+    ]
+
+    # Nothing is written, when organizations are up to date.
+    api = sync.api
+    sync.api = mock.Mock(wraps=api)
+    sync.sync_organizations()
+    assert sync.api.organization_create.call_count == 0
+    assert sync.api.organization_patch.call_count == 0
+    assert sync.api.organization_delete.call_count == 0
+    sync.api = api
+
+    db.execute(sync.t.istaiga.update().where(sync.t.istaiga.c.ID == 1), {'ADRESAS': 'Nauja g. 1'})
+    db.execute(sync.t.istaiga.delete().where(sync.t.istaiga.c.ID == 3))
+    db.execute(sync.t.rinkmena.insert(), {
+        'PAVADINIMAS': 'Testinė rinkmena nr. 1',
+        'STATUSAS': 'U',
+        'istaiga_id': 4,
+    })
+    assert sync.sync_organizations() == {
+        1: 'testine-organizacija-nr-1',
+        2: 'testine-organizacija-nr-2',
+    }
+    assert ckanapi.organization_list() == [
+        'testine-organizacija-nr-1',
+        'testine-organizacija-nr-2',
+        'unknown',
+    ]
+    organization = ckanapi.organization_show(id='testine-organizacija-nr-1')
+    assert {x['key']: x['value'] for x in organization['extras']}['Adresas'] == 'Nauja g. 1'
+    assert sync.get_organization_name({'istaiga_id': 4, 'istaiga': None}) == 'unknown'
+
+
+def test_sync_users(app, db):
+    sync = IvpkIrsSync(db)
+    ckanapi = CkanAPI({'user': 'harvest'})
+
+    for i in range(1, 3):
+        db.execute(sync.t.user.insert(), {
+            'LOGIN': 'User%d' % i,
+            'PASS': 'secret123',
+            'EMAIL': 'testas%d@testas.com' % i,
+            'FIRST_NAME': 'Jonas',
+            'LAST_NAME': 'Jonaitis',
+        })
+    db.execute(sync.t.istaiga.insert(), {
+        'PAVADINIMAS': 'Testinė organizacija nr. 1',
+        'KODAS': 888,
+        'ADRESAS': 'Testinė g. 9',
+    })
+    for user_id in (1, 1, 3):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena',
+            'STATUSAS': 'U',
+            'USER_ID': user_id,
+            'istaiga_id': 1,
+        })
+
+    sync.sync_organizations()
+    assert sync.sync_users() == {1: 'user1', 2: 'user2'}
+    assert ckanapi.user_list(q='user1')[0]['name'] == 'user1'
+    assert ckanapi.user_list(q='user2')[0]['name'] == 'user2'
+    assert ckanapi.user_list(q='unknown')[0]['name'] == 'unknown'
+
+    def members():
+        return sorted(
+            (ckanapi.user_show(id=user_id)['name'], role)
+            for user_id, _, role in ckanapi.member_list(id='testine-organizacija-nr-1', object_type='user')
+        )
+
+    assert members() == [('harvest', 'Admin'), ('unknown', 'Editor'), ('user1', 'Editor')]
+
+    # Nothing is written, when users and memberships are up to date.
+    api = sync.api
+    sync.api = mock.Mock(wraps=api)
+    sync.sync_users()
+    assert sync.api.user_create.call_count == 0
+    assert sync.api.organization_member_create.call_count == 0
+    sync.api = api
+
+
+def test_import_harvest_objects(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    db.execute(sync.t.istaiga.insert(), {
+        'PAVADINIMAS': 'Testinė organizacija nr. 1',
+        'KODAS': 888,
+        'ADRESAS': 'Testinė g. 9'
+    })
+    for i in range(1, 5):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+            'istaiga_id': 1,
+        })
+
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt')
+    job = HarvestJobObj(source=source)
+    obj_ids = OdgovltHarvester().gather_stage(job)
+
+    states = import_harvest_objects(obj_ids, workers=2)
+    assert states == {obj_id: 'COMPLETE' for obj_id in obj_ids}
+    assert sorted(CkanAPI({'user': 'harvest'}).package_list()) == ['1', '2', '3', '4']
+
+
+def test_import_pipeline(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    for i in range(1, 6):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+        })
+
+    # Workers are forked before harvest job is created.
+    pipeline = ImportPipeline(workers=2, queue_size=1)
+    submit = mocker.spy(pipeline, 'submit')
+    try:
+        source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt', config='{"gather_batch_size": 2}')
+        job = HarvestJobObj(source=source)
+        harvester = OdgovltHarvester()
+        harvester.gathered = pipeline.submit
+        obj_ids = harvester.gather_stage(job)
+        states = pipeline.join()
+    finally:
+        OdgovltHarvester().gathered = None
+        pipeline.terminate()
+
+    assert [len(call[0][0]) for call in submit.call_args_list] == [2, 2, 1]
+    assert states == {obj_id: 'COMPLETE' for obj_id in obj_ids}
+    assert sorted(CkanAPI({'user': 'harvest'}).package_list()) == ['1', '2', '3', '4', '5']
+
+
+def test_gather_stage_resumes(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    n_datasets = 20
+    for i in range(1, n_datasets + 1):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+        })
+
+    class Killed(Exception):
+        pass
+
+    get_ivpk_dataset_chunks = sync.get_ivpk_dataset_chunks
+
+    def killed_after(n):
+        # Simulates gather process being killed after reading n datasets.
+        def get_chunks(chunk_size, after_id=None, **kwargs):
+            count = 0
+            for chunk in get_ivpk_dataset_chunks(chunk_size, after_id, **kwargs):
+                if count + len(chunk) > n:
+                    yield chunk[:n - count]
+                    raise Killed()
+                count += len(chunk)
+                yield chunk
+        return get_chunks
+
+    source = HarvestSourceObj(
+        url='sqlite://',
+        source_type='opendata-gov-lt',
+        config='{"gather_batch_size": 3, "source_chunk_size": 4}',
+    )
+    harvester = OdgovltHarvester()
+    rand = random.Random(42)
+
+    for _ in range(5):
+        job = HarvestJobObj(source=source)
+        for n in sorted(rand.sample(range(n_datasets), 3)):
+            mocker.patch.object(sync, 'get_ivpk_dataset_chunks', killed_after(n))
+            with pytest.raises(Killed):
+                harvester.gather_stage(job)
+            ckan.model.Session.rollback()
+
+        mocker.patch.object(sync, 'get_ivpk_dataset_chunks', get_ivpk_dataset_chunks)
+        obj_ids = harvester.gather_stage(job)
+
+        objs = ckan.model.Session.query(ckanext.harvest.model.HarvestObject).filter_by(harvest_job_id=job.id).all()
+        assert sorted(obj_ids) == sorted(obj.id for obj in objs)
+        assert sorted(int(obj.guid) for obj in objs) == list(range(1, n_datasets + 1))
+
+        # Gather stage of a finished job is idempotent too.
+        assert sorted(harvester.gather_stage(job)) == sorted(obj_ids)
+
+    # Harvest queue deletes harvest objects of a job, whose gather stage has
+    # failed, so gather stage starts from the beginning again.
+    job = HarvestJobObj(source=source)
+    mocker.patch.object(sync, 'get_ivpk_dataset_chunks', killed_after(10))
+    with pytest.raises(Killed):
+        harvest_queue.gather_stage(harvester, job)
+    assert ckan.model.Session.query(ckanext.harvest.model.HarvestObject).filter_by(harvest_job_id=job.id).count() == 0
+
+    mocker.patch.object(sync, 'get_ivpk_dataset_chunks', get_ivpk_dataset_chunks)
+    obj_ids = harvest_queue.gather_stage(harvester, job)
+    objs = ckan.model.Session.query(ckanext.harvest.model.HarvestObject).filter_by(harvest_job_id=job.id).all()
+    assert sorted(obj_ids) == sorted(obj.id for obj in objs)
+    assert sorted(int(obj.guid) for obj in objs) == list(range(1, n_datasets + 1))
+
+
+def test_incremental_gather(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    db.execute(sync.t.user.insert(), {
+        'LOGIN': 'User1',
+        'PASS': 'secret123',
+        'EMAIL': 'testas1@testas1.com',
+        'TELEFONAS': '+37000000000',
+        'FIRST_NAME': 'Jonas',
+        'LAST_NAME': 'Jonaitis',
+    })
+    for i in range(1, 4):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+            'USER_ID': 1,
+        })
+
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt', config='{"incremental": true}')
+    harvester = OdgovltHarvester()
+
+    def harvest():
+        job = HarvestJobObj(source=source)
+        obj_ids = harvester.gather_stage(job)
+        objs = [ckanext.harvest.model.HarvestObject.get(x) for x in obj_ids]
+        for obj in objs:
+            assert harvester.import_stage(obj)
+        return sorted(obj.guid for obj in objs)
+
+    assert harvest() == ['1', '2', '3']
+    assert harvest() == []
+
+    db.execute(sync.t.rinkmena.update().where(sync.t.rinkmena.c.ID == 2), {'SANTRAUKA': 'Pakeista'})
+    db.execute(sync.t.user.update().where(sync.t.user.c.ID == 1), {'LAST_NAME': 'Jonaitė'})
+    db.execute(sync.t.rinkmena.insert(), {'PAVADINIMAS': 'Testinė rinkmena nr. 4', 'STATUSAS': 'U'})
+    assert harvest() == ['1', '2', '3', '4']
+    db.execute(sync.t.rinkmena.update().where(sync.t.rinkmena.c.ID == 2), {'SANTRAUKA': 'Dar kartą pakeista'})
+    assert harvest() == ['2']
+
+
+def test_withdraw_vanished_datasets(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+    mocker.patch('odgovlt.WITHDRAW_UNCHECKED', 0)
+
+    for i in range(1, 6):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+        })
+
+    ckanapi = CkanAPI({'user': 'harvest'})
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt', config='{"withdraw_threshold": 0.5}')
+    harvester = OdgovltHarvester()
+    run_harvest_job(HarvestJobObj(source=source, run=False), harvester)
+    assert sorted(ckanapi.package_list()) == ['1', '2', '3', '4', '5']
+
+    db.execute(sync.t.rinkmena.update().where(sync.t.rinkmena.c.ID == 2), {'STATUSAS': 'N'})
+    db.execute(sync.t.rinkmena.delete().where(sync.t.rinkmena.c.ID == 4))
+    # Datasets without institution belong to the unknown organization.
+    unknown = ckanapi.organization_show(id=get_organization_data(None)['name'])['id']
+    assert sync.get_vanished_packages() == ({'2': unknown, '4': unknown}, 5)
+    run_harvest_job(HarvestJobObj(source=source, run=False), harvester)
+    assert sorted(ckanapi.package_list()) == ['1', '3', '5']
+    assert ckanapi.package_show(id='2')['state'] == 'deleted'
+
+    # Harvest job is aborted, if too many datasets have vanished.
+    db.execute(sync.t.rinkmena.delete().where(sync.t.rinkmena.c.ID != 1))
+    job = HarvestJobObj(source=source, run=False)
+    assert harvester.gather_stage(job) == []
+    assert sorted(ckanapi.package_list()) == ['1', '3', '5']
+    assert 'withdraw_threshold' in job.gather_errors[0].message
+
+
+def test_withdraw_packages_without_organization(app, db):
+    sync = IvpkIrsSync(db)
+    ckanapi = CkanAPI({'user': 'harvest'})
+    organization = ckanapi.organization_create(name='testas', title='Testas')
+    extras = [{'key': SOURCE_NAME, 'value': SOURCE_IVPK_IRS}]
+    ckanapi.package_create(name='testas1', owner_org='testas', extras=extras)
+    ckanapi.package_create(name='testas2', extras=extras)
+    packages = get_harvested_packages()
+    assert sorted(packages.values()) == sorted([organization['id'], None])
+
+    sync.withdraw_packages(packages)
+    assert ckanapi.package_list() == []
+    assert [ckanapi.package_show(id=x)['state'] for x in ('testas1', 'testas2')] == ['deleted', 'deleted']
+
+
+def test_deferred_indexing(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    for i in range(1, 4):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+        })
+
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt', config='{"deferred_indexing": true}')
+    job = HarvestJobObj(source=source, run=False)
+    job.status = 'Running'
+    job.save()
+    harvester = OdgovltHarvester()
+    index_package = mocker.spy(ckan.lib.search.index.PackageSearchIndex, 'index_package')
+    commit = mocker.spy(ckan.lib.search.index.PackageSearchIndex, 'commit')
+    for obj_id in harvest_queue.gather_stage(harvester, job):
+        harvest_queue.fetch_and_import_stages(harvester, ckanext.harvest.model.HarvestObject.get(obj_id))
+    assert index_package.call_count == 0
+    assert ckan.lib.search.SynchronousSearchPlugin.notify.odgovlt_deferred
+
+    # Packages are indexed once, when harvest_jobs_run finds the job
+    # finished, with one commit. Harvest source is reindexed too.
+    toolkit.get_action('harvest_jobs_run')({'ignore_auth': True}, {})
+    indexed = [call[0][1]['id'] for call in index_package.call_args_list]
+    assert sorted(x for x in indexed if x != source.id) == ['1', '2', '3']
+    assert commit.call_count == 1
+
+    # Packages, written not by the harvester, are still indexed synchronously.
+    ckanapi = CkanAPI({'user': 'harvest'})
+    ckanapi.package_create(name='other-package')
+    assert index_package.call_args_list[-1][0][1]['name'] == 'other-package'
+
+
+def test_job_metrics_report(app, db, mocker, tmpdir):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+    mocker.patch.dict('odgovlt.config', {'ckanext.odgovlt.metrics_dir': str(tmpdir)})
+
+    db.execute(sync.t.kategorija.insert(), {'PAVADINIMAS': 'testas1', 'KATEGORIJA_ID': 0, 'LYGIS': 1})
+    for i in range(1, 4):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+        })
+
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt')
+    job = HarvestJobObj(source=source, run=False)
+    mocker.patch('odgovlt.METRICS_SAVE_INTERVAL', 3600)
+    save_job_metrics = mocker.spy(odgovlt, 'save_job_metrics')
+    run_harvest_job(job, OdgovltHarvester())
+
+    # Metrics are saved by gather stage and twice, when job is finished by
+    # harvest_jobs_run, not for each harvest object.
+    assert save_job_metrics.call_count == 3
+
+    report = json.loads(tmpdir.join('%s.json' % job.id).read())
+    assert report['job_id'] == job.id
+    assert report['source_id'] == source.id
+    assert report['objects'] == {'COMPLETE': 3}
+    assert report['counters'] == {
+        'gather.objects': 3,
+        'gather.unchanged': 0,
+        'import.written': 3,
+        'source.datasets': 3,
+    }
+    assert report['timers']['gather']['count'] == 1
+    assert report['timers']['sync_groups']['count'] == 1
+    assert report['timers']['import']['count'] == 3
+    assert report['timers']['ckan.group_create']['count'] == 1
+    timer = report['timers']['import.write']
+    assert len(timer['buckets']) == len(report['buckets']) + 1
+    assert sum(timer['buckets']) == timer['count'] == 3
+
+    # Job is reported once.
+    assert not OdgovltHarvester().finish_job(job.id)
+    toolkit.get_action('harvest_jobs_run')({'ignore_auth': True}, {})
+    assert save_job_metrics.call_count == 4
+
+
+def test_job_finished_by_harvest_jobs_run(app, db, mocker):
+    sync = IvpkIrsSync(db)
+    mocker.patch('odgovlt.IvpkIrsSync', return_value=sync)
+
+    for i in range(1, 5):
+        db.execute(sync.t.rinkmena.insert(), {
+            'PAVADINIMAS': 'Testinė rinkmena nr. %d' % i,
+            'STATUSAS': 'U',
+        })
+
+    source = HarvestSourceObj(url='sqlite://', source_type='opendata-gov-lt')
+    job = HarvestJobObj(source=source, run=False)
+    job.status = 'Running'
+    job.save()
+    harvester = OdgovltHarvester()
+    obj_ids = harvest_queue.gather_stage(harvester, job)
+
+    # Harvest objects are imported by several fetch consumers, metrics of
+    # some of them are never saved, but job is still finished, when all
+    # harvest objects are imported.
+    mocker.patch('odgovlt.METRICS_SAVE_INTERVAL', 3600)
+    finish_job = mocker.spy(OdgovltHarvester, 'finish_job')
+    for obj_id in obj_ids[:3]:
+        harvest_queue.fetch_and_import_stages(harvester, ckanext.harvest.model.HarvestObject.get(obj_id))
+    toolkit.get_action('harvest_jobs_run')({'ignore_auth': True}, {})
+    assert finish_job.call_count == 0
+    assert get_job_report(job.id)['objects'] == {'COMPLETE': 3, 'WAITING': 1}
+
+    odgovlt._job_metrics.clear()
+    harvest_queue.fetch_and_import_stages(harvester, ckanext.harvest.model.HarvestObject.get(obj_ids[3]))
+    toolkit.get_action('harvest_jobs_run')({'ignore_auth': True}, {})
+    assert finish_job.call_count == 1
+    assert get_job_report(job.id)['objects'] == {'COMPLETE': 4}
+
+
+def test_SourceRegistry(app, tmpdir):
+    registry = SourceRegistry()
+    url = 'sqlite:///%s' % tmpdir.join('source.db')
+
+    sync = registry.get(url, {'pool_recycle': 60})
+    assert sync.harvest_user == 'harvest'
+    assert registry.get(url, {'pool_recycle': 60}) is sync
+
+    # Changed source configuration invalidates cached entry.
+    assert registry.get(url, {'pool_recycle': 120}) is not sync
+    assert registry.get(url, {'pool_recycle': 120}).engine.pool._recycle == 120
+
+    sync = registry.get(url, {'pool_recycle': 120})
+    registry.invalidate(url)
+    assert registry.get(url, {'pool_recycle': 120}) is not sync
+
+
+def test_reflect_source_tables(db, tmpdir, mocker):
+    mocker.patch.dict('odgovlt._reflected_schemas', clear=True)
+    meta = reflect_source_tables(db, str(tmpdir))
+    assert sorted(meta.tables) == sorted(SOURCE_TABLES)
+    assert len(tmpdir.listdir()) == 1
+    assert reflect_source_tables(db, str(tmpdir)) is meta
+
+    # Cold start loads snapshot from disk and only checks schema fingerprint.
+    mocker.patch.dict('odgovlt._reflected_schemas', clear=True)
+    queries = []
+    sa.event.listen(db, 'before_cursor_execute', lambda conn, cursor, statement, *args: queries.append(statement))
+    meta = reflect_source_tables(db, str(tmpdir))
+    assert sorted(meta.tables) == sorted(SOURCE_TABLES)
+    assert len(queries) == 1
+
+    # Schema change invalidates snapshot.
+    db.execute('ALTER TABLE t_user ADD COLUMN NICKNAME VARCHAR(20)')
+    meta = reflect_source_tables(db, str(tmpdir))
+    assert 'NICKNAME' in meta.tables['t_user'].c
+    assert len(tmpdir.listdir()) == 2
+
+
+def test_TagNormalizer(caplog):
+    normalizer = TagNormalizer()
+    rejected = collections.Counter()
+    assert normalizer.normalize_many([
+        'Keliai, eismo intensyvumas; e',
+        'keliai,e,' + 'a' * 101,
+        None,
+    ], rejected) == [
+        ['keliai', 'eismo intensyvumas'],
+        ['keliai'],
+        [],
+    ]
+    assert rejected == {
+        ('too short tag', 'e'): 2,
+        ('very long tag', 'a' * 101): 1,
+    }
+
+    caplog.set_level(logging.WARNING, logger='odgovlt')
+    normalizer.report_rejected(rejected)
+    assert [r.getMessage() for r in caplog.records if r.name == 'odgovlt'] == [
+        "skipped 3 tags (2 distinct): too short tag: u'e' (2); very long tag: u'%s' (1)" % ('a' * 101),
+    ]
+
+
+def reference_slugify(title=None, length=90):
+    # Original implementation, which slugify must match exactly.
+    if not title:
+        return ''
+
+    # Replace all non-ascii characters to ascii equivalents.
+    slug = unidecode.unidecode(title)
+
+    # Make slug.
+    slug = str(re.sub(r'[^\w\s-]', '', slug).strip().lower())
+    slug = re.sub(r'[-\s]+', '-', slug)
+
+    # Make sure, that slug is not longer that specied in `length`.
+    if len(slug) > length:
+        left = []
+        right = []
+        words = slug.split('-')
+        split = int(len(words) * .6)
+        index = itertools.izip_longest(
+            ((i, left) for i in range(split)),
+            ((i, right) for i in range(len(words) - 1, split - 1, -1)),
+        )
+        index = (i for i in
+                 itertools.chain.from_iterable(index) if i is not None)
+        total = 0
+        for k, (i, q) in zip(itertools.chain([0], itertools.count(2)), index):
+            if total + len(words[i]) + k > length:
+                break
+            else:
+                q.append(words[i])
+                total += len(words[i])
+        slug = '-'.join(left) + '--' + '-'.join(right)
+
+    return slug
+
+
 def test_slugify():
     title = (
         'Radiacinės saugos centro išduotų galiojančių '
@@ -397,3 +1296,19 @@ def test_slugify():
     assert len(slugify(title, length=42)) < 42
     assert slugify(title, length=42) == 'radiacines-saugos--duomenys-saltiniais'
     assert slugify() == ''
+
+
+def test_slugify_many():
+    # Memoized slugs must be exactly the same as the original ones.
+    rand = random.Random(42)
+    chars = 'aąbcčdeęėfghiįyjklmnoprsštuųūvzžAĄČĘĖĮŠŲŪŽ0123456789 -_.,;:"()/\t'
+    titles = [
+        ''.join(rand.choice(chars) for _ in range(rand.randint(0, 200)))
+        for _ in range(2000)
+    ]
+    for length in (1, 5, 42, 90):
+        expected = [reference_slugify(title, length=length) for title in titles]
+        assert slugify_many(titles, length) == expected
+        # Second time slugs are taken from the cache.
+        assert slugify_many(titles, length) == expected
+        assert [type(x) for x in slugify_many(titles, length)] == [type(x) for x in expected]